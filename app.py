@@ -1,10 +1,24 @@
 import streamlit as st
-from llm_engine import LLMEngine
+from llm_engine import LLMEngine, warm_up
 from file_handler import FileHandler
+from response_cache import RESPONSE_CACHE
+from query_cache import QUERY_CACHE
+from client_registry import key_fingerprint
+from metrics import METRICS, start_metrics_server
+from stream_renderer import StreamRenderer
+from provider_router import provider_health
+from index_registry import INDEXES
+from conversation_store import CONVERSATIONS
 import os
+import re
+import uuid
 
 st.set_page_config(page_title="Personal AI", page_icon="🤖", layout="wide")
 
+# Optional Prometheus endpoint for the span timings (started once per process)
+if os.getenv("PERSONAL_LLM_METRICS_PORT"):
+    start_metrics_server(int(os.getenv("PERSONAL_LLM_METRICS_PORT")))
+
 # ---------------------------------------------------------
 # ChatGPT Style CSS
 # ---------------------------------------------------------
@@ -94,6 +108,40 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ---------------------------------------------------------
+# Conversations (saved in SQLite, loaded a page at a time)
+# ---------------------------------------------------------
+# Only the latest messages are loaded and rendered; older ones are fetched on demand
+MAX_RENDERED_MESSAGES = 40
+HISTORY_PAGE = 20
+
+# History belongs to one browser: a random owner id kept in the URL, so a reload or a
+# bookmark finds the same chats while other visitors of the same server never see them
+owner = st.query_params.get("owner", "")
+if not re.fullmatch(r"[0-9a-f]{32}", owner):
+    owner = uuid.uuid4().hex
+    st.query_params["owner"] = owner
+
+def restore_conversation(engine):
+    """
+    Gives the engine the open conversation's recent messages and the documents it was bound to.
+    """
+    conversation = CONVERSATIONS.get(owner, st.session_state.conversation_id)
+    if conversation is None:
+        return
+    engine.load_history(st.session_state.messages[-MAX_RENDERED_MESSAGES:])
+    missing = engine.restore_documents(conversation["file_hashes"])
+    if missing:
+        st.toast(f"{len(missing)} file(s) of this chat aren't indexed for this model. Upload them again.")
+
+def open_conversation(conversation_id):
+    st.session_state.conversation_id = conversation_id
+    st.session_state.messages = CONVERSATIONS.messages(owner, conversation_id, limit=MAX_RENDERED_MESSAGES)
+    st.session_state.show_all_messages = False
+    st.session_state.chat_engine = None
+    if st.session_state.get("engine"):
+        restore_conversation(st.session_state.engine)
+
 # ---------------------------------------------------------
 # Sidebar Layout (ChatGPT Style)
 # ---------------------------------------------------------
@@ -103,11 +151,23 @@ st.markdown("""
 with st.sidebar:
     if st.button("➕ New Chat", use_container_width=True):
         st.session_state.messages = []
+        st.session_state.conversation_id = None
+        st.session_state.show_all_messages = False
+        if st.session_state.get("engine"):
+            st.session_state.engine.reset_memory()
         st.rerun()
     
     st.markdown("### History")
-    st.button("📝 Chat 1", use_container_width=True)
-    st.button("📝 Chat 2", use_container_width=True)
+    history_limit = st.session_state.get("history_limit", HISTORY_PAGE)
+    conversations = CONVERSATIONS.list(owner, limit=history_limit)
+    for conversation in conversations:
+        icon = "💬" if conversation["id"] == st.session_state.get("conversation_id") else "📝"
+        if st.button(f"{icon} {conversation['title']}", key=f"chat_{conversation['id']}", use_container_width=True):
+            open_conversation(conversation["id"])
+            st.rerun()
+    if len(conversations) == history_limit and st.button("More", use_container_width=True):
+        st.session_state.history_limit = history_limit + HISTORY_PAGE
+        st.rerun()
     
     st.markdown("---")
     
@@ -133,6 +193,47 @@ with st.sidebar:
         else:
             provider_code = "ollama"
 
+        # Failover to other providers that have a key configured (and hedging when the first is slow)
+        fallbacks = []
+        if st.toggle("Failover", value=False, help="Switch provider automatically if the current one fails or stalls"):
+            groq_key = st.secrets.get("GROQ_API_KEY") or os.getenv("GROQ_API_KEY")
+            google_key = st.secrets.get("GOOGLE_API_KEY") or os.getenv("GOOGLE_API_KEY")
+            if provider_code != "groq" and groq_key:
+                fallbacks.append(("groq", "llama3-8b-8192", groq_key))
+            if provider_code != "gemini" and google_key:
+                fallbacks.append(("gemini", "gemini-1.5-flash", google_key))
+            if not fallbacks:
+                st.caption("Set GROQ_API_KEY or GOOGLE_API_KEY to enable a fallback.")
+        hedge_after = None
+        if fallbacks and st.toggle("Hedge slow replies", value=False):
+            hedge_after = st.slider("Hedge after (s)", 1, 30, 5)
+
+        # Hybrid search: BM25 keywords + vectors, reranked down to a few chunks
+        use_hybrid = st.toggle("Hybrid search", value=False, help="Better recall on names, numbers and non-English text")
+        retrieval_mode = "hybrid" if use_hybrid else "vector"
+        top_k = st.slider("Context chunks", 1, 10, 3 if use_hybrid else 2)
+
+        # Opt-in: reuse answers to near-identical questions on the same documents
+        use_cache = st.toggle("Answer cache", value=False, help="Reply instantly to repeated questions")
+        if use_cache:
+            stats = RESPONSE_CACHE.stats()
+            st.caption(f"Cache: {stats['hits']} hits / {stats['misses']} misses")
+
+        # Admin: timings for parse / chunk / embed / index / retrieve / first token / generation
+        if st.toggle("Metrics", value=False):
+            rows = METRICS.summary()
+            if rows:
+                st.dataframe(rows, hide_index=True, use_container_width=True)
+            else:
+                st.caption("No timings recorded yet.")
+            memo = QUERY_CACHE.stats()
+            st.caption(f"Query memo: {memo['result_hits']} retrieval / {memo['embedding_hits']} embedding hits")
+            shared = INDEXES.stats()
+            st.caption(f"Shared indexes: {shared['indexes']} ({shared['in_use']} in use, ~{shared['mb']:.0f} MB)")
+            health = provider_health()
+            if health:
+                st.dataframe(health, hide_index=True, use_container_width=True)
+
     # Files (Removed from Sidebar to use Floating +)
     # kept empty or minimal
     pass
@@ -259,6 +360,8 @@ st.divider()
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = None
 
 if "engine" not in st.session_state:
     st.session_state.engine = None
@@ -270,6 +373,9 @@ if "processing_trigger" not in st.session_state:
 
 if "uploaded_files" not in st.session_state:
     st.session_state.uploaded_files = []
+# Hashes of the files indexed from the uploader, as opposed to those restored with a saved chat
+if "uploaded_hashes" not in st.session_state:
+    st.session_state.uploaded_hashes = set()
 
 # Init Engine Logic (Graceful)
 if provider_code == "groq" and not api_key:
@@ -278,6 +384,47 @@ if provider_code == "groq" and not api_key:
 elif provider_code == "gemini" and not api_key:
     pass
 
+def ensure_engine():
+    """
+    (Re)creates the session's engine when provider, model, key or failover settings change;
+    otherwise keeps it, with its index and conversation.
+    """
+    model_name = st.session_state.get("float_model", "llama3") # Get from float widget
+    engine_key = (
+        provider_code, model_name, key_fingerprint(api_key),
+        tuple((p, m, key_fingerprint(k)) for p, m, k in fallbacks), hedge_after,
+    )
+    if not st.session_state.engine or st.session_state.get("engine_key") != engine_key:
+        st.session_state.engine = LLMEngine(
+            provider=provider_code,
+            model_name=model_name,
+            api_key=api_key,
+            fallbacks=fallbacks,
+            hedge_after=hedge_after,
+        )
+        st.session_state.engine_key = engine_key
+        st.session_state.chat_engine = None
+        if st.session_state.conversation_id:
+            restore_conversation(st.session_state.engine)
+    return st.session_state.engine
+
+def ensure_chat_engine():
+    """
+    (Re)builds the chat engine when answer cache, hybrid search or context chunks change.
+    The conversation lives in the engine's memory, so it carries over.
+    """
+    settings = (use_cache, retrieval_mode, top_k)
+    if not st.session_state.chat_engine or st.session_state.get("chat_engine_settings") != settings:
+        st.session_state.chat_engine = st.session_state.engine.get_chat_engine(
+            use_cache=use_cache, retrieval_mode=retrieval_mode, top_k=top_k
+        )
+        st.session_state.chat_engine_settings = settings
+    return st.session_state.chat_engine
+
+# Load the selected provider (and, for Ollama, its models) while the user is still typing
+if provider_code == "ollama" or api_key:
+    warm_up(provider_code, st.session_state.get("float_model", "llama3"), api_key)
+
 # File Processing
 if st.session_state.processing_trigger and st.session_state.uploaded_files:
     st.session_state.processing_trigger = False # Reset
@@ -285,17 +432,36 @@ if st.session_state.processing_trigger and st.session_state.uploaded_files:
         st.error("Please provide an API Key.")
     else:
         with st.status("Analyzing documents...", expanded=True) as status:
+            # Clicking Cancel makes Streamlit stop this run at its next progress update;
+            # the index is only swapped once every file is in, so it stays as it was.
+            st.button("Cancel", on_click=lambda: st.session_state.update(ingest_cancelled=True))
             try:
-                # Init Engine
-                st.session_state.engine = LLMEngine(
-                    provider=provider_code,
-                    model_name=st.session_state.get("float_model", "llama3"), # Get from float widget
-                    api_key=api_key
-                )
+                # Init Engine (kept across runs so its index can be updated in place)
+                engine = ensure_engine()
                 
-                documents = FileHandler.process_uploaded_files(st.session_state.uploaded_files)
-                st.session_state.engine.create_index(documents)
-                st.session_state.chat_engine = st.session_state.engine.get_chat_engine()
+                # Push only the delta: files removed from the uploader, and files not indexed yet.
+                # Files restored with a saved chat never were in the uploader, so they stay.
+                upload_hashes = {FileHandler.content_hash(f.getbuffer()): f for f in st.session_state.uploaded_files}
+                engine.remove_documents([h for h in st.session_state.uploaded_hashes if h not in upload_hashes])
+                st.session_state.uploaded_hashes = set(upload_hashes)
+                new_files = [f for h, f in upload_hashes.items() if h not in engine.indexed_files]
+                
+                # Per-file progress: large files advance page by page / batch by batch
+                progress_bars = {}
+                def show_progress(file_name, fraction):
+                    if file_name not in progress_bars:
+                        progress_bars[file_name] = st.progress(0.0)
+                    progress_bars[file_name].progress(min(fraction, 1.0), text=f"{file_name} ({fraction:.0%})")
+                
+                # Stream parsed files straight into the index as they finish
+                documents = FileHandler.iter_documents(
+                    new_files, on_progress=show_progress, provider=engine.provider, model=engine.model_name
+                )
+                engine.add_documents(documents)
+                if st.session_state.conversation_id:
+                    CONVERSATIONS.bind_files(owner, st.session_state.conversation_id, engine.indexed_files)
+                st.session_state.chat_engine = None
+                ensure_chat_engine()
                 
                 status.update(label="Context Ready", state="complete", expanded=False)
                 
@@ -303,6 +469,9 @@ if st.session_state.processing_trigger and st.session_state.uploaded_files:
                 status.update(label="Error", state="error")
                 st.error(str(e))
 
+if st.session_state.pop("ingest_cancelled", False):
+    st.toast("Upload cancelled.")
+
 # Welcome Message if empty
 if not st.session_state.messages:
     st.markdown("""
@@ -313,9 +482,21 @@ if not st.session_state.messages:
     """, unsafe_allow_html=True)
 
 # Chat Loop
+# Only the loaded window is rendered; the model itself sees a token-budgeted history
+if st.session_state.messages and st.session_state.messages[0]["seq"] > 0:
+    if st.button(f"Show {st.session_state.messages[0]['seq']} earlier messages"):
+        earlier = CONVERSATIONS.messages(
+            owner, st.session_state.conversation_id, limit=MAX_RENDERED_MESSAGES, before=st.session_state.messages[0]["seq"]
+        )
+        st.session_state.messages = earlier + st.session_state.messages
+        st.session_state.show_all_messages = True
+        st.rerun()
+
 for msg in st.session_state.messages:
     with st.chat_message(msg["role"]):
         st.markdown(msg["content"])
+        if msg.get("prompt_tokens"):
+            st.caption(f"{msg['prompt_tokens']} prompt tokens")
 
 # Chat Input
 if prompt := st.chat_input("Message..."):
@@ -325,39 +506,52 @@ if prompt := st.chat_input("Message..."):
     elif provider_code == "gemini" and not api_key:
         st.warning("⚠️ Please enter Gemini API Key in Settings (Sidebar).")
     else:
-        # Proceed
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        # Proceed (the first message opens a saved conversation, titled after it)
+        if not st.session_state.conversation_id:
+            engine = st.session_state.engine
+            st.session_state.conversation_id = CONVERSATIONS.create(
+                owner, prompt, file_hashes=engine.indexed_files if engine else ()
+            )
+        seq = CONVERSATIONS.append(owner, st.session_state.conversation_id, "user", prompt)
+        st.session_state.messages.append({"seq": seq, "role": "user", "content": prompt})
         with st.chat_message("user"):
             st.markdown(prompt)
 
         # AI Response
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
-            full_response = ""
+            # Coalesces tokens: redraws every ~50 ms rather than on every token
+            renderer = StreamRenderer(message_placeholder)
+            prompt_tokens = 0
             
             try:
-                # Auto-init if needed
-                if not st.session_state.engine:
-                    st.session_state.engine = LLMEngine(
-                        provider=provider_code, 
-                        model_name=st.session_state.get("float_model", "llama3"), # Get from float widget
-                        api_key=api_key
-                    )
+                # Init, or rebuild if provider, model or failover settings changed
+                ensure_engine()
                 
-                # Ensure Chat Engine
-                if not st.session_state.chat_engine:
-                     st.session_state.chat_engine = st.session_state.engine.get_chat_engine()
+                # Ensure Chat Engine (rebuilt if the Settings changed)
+                ensure_chat_engine()
 
-                # Generate
+                # Generate (cache hits never read the memory, so they report 0 prompt tokens)
+                memory = st.session_state.engine.memory
+                memory.last_prompt_tokens = 0
                 response_iter = st.session_state.chat_engine.stream_chat(prompt)
 
                 for part in response_iter.response_gen:
-                    full_response += part
-                    message_placeholder.markdown(full_response + "▌")
+                    renderer.write(part)
                 
-                message_placeholder.markdown(full_response)
+                renderer.finish()
+                prompt_tokens = memory.last_prompt_tokens
+                if prompt_tokens:
+                    st.caption(f"{prompt_tokens} prompt tokens")
                 
             except Exception as e:
                 st.error(f"Error: {str(e)}")
         
-        st.session_state.messages.append({"role": "assistant", "content": full_response})
+        full_response = renderer.text()
+        # A failed turn leaves no reply to save; the user's message stays, ready to be asked again
+        if full_response:
+            seq = CONVERSATIONS.append(owner, st.session_state.conversation_id, "assistant", full_response, prompt_tokens)
+            st.session_state.messages.append({"seq": seq, "role": "assistant", "content": full_response, "prompt_tokens": prompt_tokens})
+        # Keep the rendered window bounded; older messages stay one click away in the store
+        if not st.session_state.get("show_all_messages"):
+            del st.session_state.messages[:-MAX_RENDERED_MESSAGES]
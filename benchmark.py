@@ -0,0 +1,327 @@
+"""
+Offline benchmark for ingestion, indexing, retrieval and streaming chat.
+
+Runs the real FileHandler / LLMEngine code paths against deterministic local stand-ins
+for the LLM and embedding providers, so no Ollama, network or API key is needed.
+Results are written as JSON; pass --compare with an earlier results file to see deltas.
+
+    python benchmark.py --corpus-sizes 10 50 200 --sessions 1 4 8 --output bench.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+# Keep the benchmark's embedding cache away from the app's .index_store/
+os.environ.setdefault("PERSONAL_LLM_INDEX_DIR", tempfile.mkdtemp(prefix="personal_llm_bench_"))
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.llms import CompletionResponse, CustomLLM, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+from file_handler import FileHandler
+from llm_engine import LLMEngine, HYBRID_CANDIDATE_TOP_K
+from hybrid_retrieval import BM25Index, EmbeddingReranker, HybridRetriever
+from index_store import DEFAULT_INDEX_DIR
+from client_registry import CLIENTS, key_fingerprint
+from query_cache import QUERY_CACHE
+
+PROVIDER = "ollama"
+MODEL_NAME = "bench"
+
+WORDS = (
+    "alpha beta gamma delta model index vector memory token stream query answer document "
+    "section page report budget latency cache server client network policy invoice contract "
+    "भाषा दस्तावेज़ ಕನ್ನಡ ಪುಸ್ತಕ datos informe"
+).split()
+
+
+class BenchEmbedding(BaseEmbedding):
+    """
+    Deterministic embeddings derived from a hash of the text, with an optional per-call delay
+    to stand in for a provider round trip.
+    """
+    embed_dim: int = 256
+    delay: float = 0.0
+
+    @classmethod
+    def class_name(cls):
+        return "BenchEmbedding"
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(self.embed_dim).astype(np.float32).tolist()
+
+    def _get_query_embedding(self, query):
+        time.sleep(self.delay)
+        return self._vector(query)
+
+    def _get_text_embedding(self, text):
+        time.sleep(self.delay)
+        return self._vector(text)
+
+    def _get_text_embeddings(self, texts):
+        time.sleep(self.delay)
+        return [self._vector(text) for text in texts]
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+
+class BenchLLM(CustomLLM):
+    """
+    Streams a fixed number of tokens after a configurable first-token delay.
+    """
+    num_output: int = 64
+    first_token_delay: float = 0.0
+    token_delay: float = 0.0
+
+    @property
+    def metadata(self):
+        return LLMMetadata(context_window=8192, num_output=self.num_output, model_name=MODEL_NAME)
+
+    def _tokens(self):
+        return [f"tok{i} " for i in range(self.num_output)]
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        time.sleep(self.first_token_delay + self.token_delay * self.num_output)
+        return CompletionResponse(text="".join(self._tokens()))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        def gen():
+            time.sleep(self.first_token_delay)
+            text = ""
+            for token in self._tokens():
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+                time.sleep(self.token_delay)
+        return gen()
+
+
+class FakeUpload(io.BytesIO):
+    """
+    Just enough of Streamlit's UploadedFile (also a BytesIO) for FileHandler.
+    """
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+
+def make_corpus(num_files, words_per_file, seed=0):
+    rng = random.Random(seed)
+    uploads = []
+    for i in range(num_files):
+        text = " ".join(rng.choice(WORDS) for _ in range(words_per_file))
+        uploads.append(FakeUpload(f"doc_{seed}_{i}.txt", text.encode("utf-8")))
+    return uploads
+
+
+def make_queries(count, seed=1):
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(6)) for _ in range(count)]
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {"p50": None, "p95": None, "mean": None}
+    return {
+        "p50": ordered[int(0.50 * (len(ordered) - 1))],
+        "p95": ordered[int(0.95 * (len(ordered) - 1))],
+        "mean": statistics.fmean(ordered),
+    }
+
+
+def new_engine():
+    return LLMEngine(provider=PROVIDER, model_name=MODEL_NAME)
+
+
+def bench_ingest(uploads):
+    start = time.perf_counter()
+    documents = list(FileHandler.iter_documents(uploads, provider=PROVIDER, model=MODEL_NAME))
+    elapsed = time.perf_counter() - start
+    total_bytes = sum(len(u.getvalue()) for u in uploads)
+    return documents, {
+        "files": len(uploads),
+        "documents": len(documents),
+        "seconds": elapsed,
+        "files_per_sec": len(uploads) / elapsed if elapsed else None,
+        "mb_per_sec": total_bytes / 1e6 / elapsed if elapsed else None,
+    }
+
+
+def bench_index(documents):
+    # Cold: nothing cached yet. Warm: a second session with the same files (attaches to the shared index).
+    results = {}
+    for label in ("cold", "warm"):
+        engine = new_engine()
+        start = time.perf_counter()
+        engine.create_index(documents)
+        results[f"{label}_seconds"] = time.perf_counter() - start
+    results["chunks"] = len(engine.index.docstore.docs)
+    return engine, results
+
+
+def bench_retrieval(engine, queries, top_k):
+    vector = engine.index.as_retriever(similarity_top_k=top_k)
+    hybrid = HybridRetriever(
+        engine.index.as_retriever(similarity_top_k=HYBRID_CANDIDATE_TOP_K),
+        BM25Index(engine.index.docstore.docs.values()),
+        EmbeddingReranker(embed_model=engine.embed_model, top_n=top_k, vector_store=engine.index.vector_store),
+        candidate_top_k=HYBRID_CANDIDATE_TOP_K,
+    )
+    results = {}
+    for label, retriever in (("vector", vector), ("hybrid", hybrid)):
+        samples = []
+        for query in queries:
+            start = time.perf_counter()
+            retriever.retrieve(query)
+            samples.append(time.perf_counter() - start)
+        results[label] = percentiles(samples)
+    return results
+
+
+def _run_session(documents, queries, session):
+    engine = new_engine()
+    engine.create_index(documents)
+    chat_engine = engine.get_chat_engine()
+    ttft, rates = [], []
+    # Each session asks its own questions, so none is served another's memoized retrieval
+    for query in (f"{query} (session {session})" for query in queries):
+        start = time.perf_counter()
+        first = None
+        tokens = 0
+        for _ in chat_engine.stream_chat(query).response_gen:
+            if first is None:
+                first = time.perf_counter() - start
+            tokens += 1
+        elapsed = time.perf_counter() - start
+        if first is None:
+            continue
+        ttft.append(first)
+        if elapsed > first:
+            rates.append(tokens / (elapsed - first))
+    return ttft, rates
+
+
+def bench_chat(documents, queries, sessions):
+    # Nothing memoized by an earlier run carries over into this one
+    QUERY_CACHE.clear()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        results = list(pool.map(lambda session: _run_session(documents, queries, session), range(sessions)))
+    elapsed = time.perf_counter() - start
+    ttft = [t for session_ttft, _ in results for t in session_ttft]
+    rates = [r for _, session_rates in results for r in session_rates]
+    return {
+        "sessions": sessions,
+        "turns": len(ttft),
+        "seconds": elapsed,
+        "ttft": percentiles(ttft),
+        "tokens_per_sec": percentiles(rates),
+    }
+
+
+def run(args):
+    llm = BenchLLM(
+        num_output=args.output_tokens,
+        first_token_delay=args.first_token_delay,
+        token_delay=args.token_delay,
+    )
+    embed_model = BenchEmbedding(model_name="bench-embed", delay=args.embed_delay)
+    # Pre-seed the client registry so LLMEngine picks up the stand-ins instead of Ollama
+    CLIENTS.get_or_create((PROVIDER, MODEL_NAME, key_fingerprint(None)), lambda: (llm, embed_model))
+
+    queries = make_queries(args.queries)
+    runs = []
+    for corpus_size in args.corpus_sizes:
+        print(f"Corpus of {corpus_size} files...", file=sys.stderr)
+        uploads = make_corpus(corpus_size, args.words_per_file, seed=corpus_size)
+        documents, ingest = bench_ingest(uploads)
+        engine, index = bench_index(documents)
+        retrieval = bench_retrieval(engine, queries, args.top_k)
+        chat = [bench_chat(documents, queries[: args.turns], sessions) for sessions in args.sessions]
+        runs.append({
+            "corpus_files": corpus_size,
+            "ingest": ingest,
+            "index": index,
+            "retrieval": retrieval,
+            "chat": chat,
+        })
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "index_dir": DEFAULT_INDEX_DIR,
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "runs": runs,
+    }
+
+
+def _flatten(value, prefix=""):
+    if isinstance(value, dict):
+        items = {}
+        for k, v in value.items():
+            items.update(_flatten(v, f"{prefix}{k}."))
+        return items
+    if isinstance(value, list):
+        items = {}
+        for i, v in enumerate(value):
+            label = v.get("corpus_files", v.get("sessions", i)) if isinstance(v, dict) else i
+            items.update(_flatten(v, f"{prefix}{label}."))
+        return items
+    return {prefix.rstrip("."): value}
+
+
+def compare(results, baseline):
+    """
+    Prints the relative change of every numeric metric present in both runs.
+    """
+    current = _flatten(results["runs"])
+    previous = _flatten(baseline["runs"])
+    for key in sorted(current.keys() & previous.keys()):
+        new, old = current[key], previous[key]
+        if isinstance(new, (int, float)) and isinstance(old, (int, float)) and old:
+            print(f"{key:60s} {old:12.4f} -> {new:12.4f} ({(new - old) / old:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--words-per-file", type=int, default=2000)
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--queries", type=int, default=50, help="Queries for the retrieval latency run")
+    parser.add_argument("--turns", type=int, default=5, help="Chat turns per session")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--output-tokens", type=int, default=64)
+    parser.add_argument("--first-token-delay", type=float, default=0.0, help="Simulated LLM latency (s)")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Simulated per-token latency (s)")
+    parser.add_argument("--embed-delay", type=float, default=0.0, help="Simulated embedding call latency (s)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Earlier results file to diff against")
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
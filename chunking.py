@@ -0,0 +1,157 @@
+import os
+import re
+import logging
+import statistics
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.node_parser.node_utils import build_nodes_from_splits
+from llama_index.core.utils import get_tokenizer
+
+logger = logging.getLogger(__name__)
+
+# Target chunk size (tokens) per embedding provider. Gemini's embedding model takes 2048-token
+# inputs; Ollama's embedding models are usually run with smaller contexts. Groq embeds through Gemini.
+PROVIDER_CHUNK_TOKENS = {"gemini": 1024, "groq": 1024, "ollama": 512}
+DEFAULT_CHUNK_TOKENS = 512
+
+MARKDOWN_HEADING = re.compile(r"^#{1,6}\s")
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+def _looks_like_heading(paragraph):
+    # docx2txt and plain text lose heading styles: a short single line without
+    # sentence punctuation, standing alone as a paragraph, is treated as a heading.
+    text = paragraph.strip()
+    return 0 < len(text) <= 80 and "\n" not in text and not text.endswith((".", ",", ";", ":", "?", "!"))
+
+
+class ChunkingPipeline:
+    def __init__(self, chunk_size=DEFAULT_CHUNK_TOKENS, chunk_overlap=None, min_chunk_size=None, max_workers=None):
+        """
+        Format-aware splitting of FileHandler Documents into nodes of roughly chunk_size tokens.
+        CSV files are cut into row groups that repeat the header; DOCX, Markdown and text files
+        are split at headings first; everything is then sentence-split down to size, and chunks
+        smaller than min_chunk_size are merged with their neighbours.
+        Documents (e.g. PDF pages) are tokenized on a thread pool; the tokenizer releases the GIL.
+        """
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap if chunk_overlap is not None else chunk_size // 10
+        self.min_chunk_size = min_chunk_size if min_chunk_size is not None else chunk_size // 4
+        self.max_workers = max_workers or int(os.getenv("PERSONAL_LLM_CHUNK_WORKERS", min(8, os.cpu_count() or 1)))
+        self.tokenizer = get_tokenizer()
+        self.splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=self.chunk_overlap)
+        self.last_stats = None
+
+    @classmethod
+    def for_provider(cls, provider):
+        """
+        Pipeline sized for the provider's embedding model; PERSONAL_LLM_CHUNK_TOKENS overrides.
+        """
+        chunk_size = int(os.getenv("PERSONAL_LLM_CHUNK_TOKENS", PROVIDER_CHUNK_TOKENS.get(provider, DEFAULT_CHUNK_TOKENS)))
+        return cls(chunk_size=chunk_size)
+
+    @property
+    def config_key(self):
+        """
+        Identifies the chunking settings, so nodes cached on disk are never reused across settings.
+        """
+        return f"chunks{self.chunk_size}-{self.chunk_overlap}-{self.min_chunk_size}"
+
+    def _count(self, text):
+        return len(self.tokenizer(text))
+
+    def _sections(self, document):
+        text = document.get_content()
+        extension = Path(document.metadata.get("file_name", "")).suffix.lower()
+        if extension == ".csv":
+            return self._csv_sections(text)
+        if extension == ".md":
+            return self._split_at(text.splitlines(keepends=True), lambda line: MARKDOWN_HEADING.match(line))
+        if extension in (".docx", ".txt"):
+            paragraphs = [p + "\n\n" for p in PARAGRAPH_BREAK.split(text)]
+            return self._split_at(paragraphs, _looks_like_heading)
+        return [text]
+
+    @staticmethod
+    def _split_at(pieces, is_heading):
+        sections = [""]
+        for piece in pieces:
+            if is_heading(piece) and sections[-1].strip():
+                sections.append("")
+            sections[-1] += piece
+        return [section for section in sections if section.strip()]
+
+    def _csv_sections(self, text):
+        lines = text.splitlines()
+        if len(lines) < 2:
+            return [text]
+        header, rows = lines[0], lines[1:]
+        budget = self.chunk_size - self._count(header)
+        sections, group, used = [], [], 0
+        for row in rows:
+            cost = self._count(row)
+            if group and used + cost > budget:
+                sections.append("\n".join([header, *group]))
+                group, used = [], 0
+            group.append(row)
+            used += cost
+        if group:
+            sections.append("\n".join([header, *group]))
+        return sections
+
+    def _merge_small(self, chunks):
+        merged = []
+        for chunk, size in chunks:
+            if merged:
+                previous, previous_size = merged[-1]
+                if (previous_size < self.min_chunk_size or size < self.min_chunk_size) and previous_size + size <= self.chunk_size:
+                    merged[-1] = (previous + "\n\n" + chunk, previous_size + size)
+                    continue
+            merged.append((chunk, size))
+        return merged
+
+    def _split_document(self, document):
+        chunks = []
+        for section in self._sections(document):
+            size = self._count(section)
+            if size <= self.chunk_size:
+                chunks.append((section.strip(), size))
+            else:
+                chunks.extend((piece, self._count(piece)) for piece in self.splitter.split_text(section))
+        chunks = self._merge_small([(chunk, size) for chunk, size in chunks if chunk])
+        nodes = build_nodes_from_splits([chunk for chunk, _ in chunks], document)
+        # build_nodes_from_splits leaves metadata empty; like llama_index's NodeParser, every
+        # chunk carries its document's (file_hash and file_name key the caches, page_label is cited)
+        for node in nodes:
+            node.metadata = {**document.metadata, **node.metadata}
+        return nodes, [size for _, size in chunks]
+
+    def get_nodes_from_documents(self, documents, **kwargs):
+        """
+        Same interface as llama_index node parsers, so it can be passed to IndexStore.build_nodes.
+        """
+        documents = list(documents)
+        if len(documents) > 1 and self.max_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(documents))) as pool:
+                results = list(pool.map(self._split_document, documents))
+        else:
+            results = [self._split_document(document) for document in documents]
+
+        nodes = [node for document_nodes, _ in results for node in document_nodes]
+        sizes = sorted(size for _, document_sizes in results for size in document_sizes)
+        if sizes:
+            self.last_stats = {
+                "chunks": len(sizes),
+                "min_tokens": sizes[0],
+                "p50_tokens": sizes[len(sizes) // 2],
+                "p95_tokens": sizes[int(0.95 * (len(sizes) - 1))],
+                "max_tokens": sizes[-1],
+                "mean_tokens": statistics.fmean(sizes),
+            }
+            logger.info(
+                f"Chunked {len(documents)} documents into {len(sizes)} chunks "
+                f"(tokens: min {sizes[0]}, p50 {self.last_stats['p50_tokens']}, "
+                f"p95 {self.last_stats['p95_tokens']}, max {sizes[-1]})"
+            )
+        return nodes
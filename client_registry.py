@@ -0,0 +1,69 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def key_fingerprint(api_key):
+    """
+    Short, non-reversible tag for an API key, so registry keys never hold the secret itself.
+    """
+    if not api_key:
+        return "-"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class ClientRegistry:
+    def __init__(self, max_entries=8):
+        """
+        Process-wide LRU cache of LLM / embedding clients.
+        Streamlit re-runs app.py on every interaction, but imported modules stay loaded,
+        so clients kept here (and their pooled HTTP connections) survive reruns and are
+        shared by every session using the same provider, model and key.
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._building = {}  # key -> lock held while that key's clients are built
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            building = self._building.setdefault(key, threading.Lock())
+
+        # Built outside the registry lock, so a slow client (or a background warm-up) only
+        # holds up sessions waiting for the same key
+        with building:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+            try:
+                logger.info(f"Creating clients for {key[0]}/{key[1]}")
+                value = factory()
+            except Exception:
+                with self._lock:
+                    self._building.pop(key, None)
+                raise
+            with self._lock:
+                self._building.pop(key, None)
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    evicted, _ = self._entries.popitem(last=False)
+                    logger.info(f"Evicted clients for {evicted[0]}/{evicted[1]}")
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+CLIENTS = ClientRegistry(max_entries=int(os.getenv("PERSONAL_LLM_MAX_CLIENTS", 8)))
@@ -0,0 +1,180 @@
+import os
+import logging
+import threading
+from typing import Optional
+from llama_index.core.base.response.schema import StreamingResponse
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.chat_engine import ContextChatEngine
+from llama_index.core.chat_engine.types import AgentChatResponse, StreamingAgentChatResponse, ToolOutput
+from llama_index.core.llms import LLM, ChatMessage, ChatResponse, MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.schema import MetadataMode
+from llama_index.core.types import Thread
+
+logger = logging.getLogger(__name__)
+
+# Share of the token budget the running summary may take; the rest holds recent turns verbatim
+SUMMARY_SHARE = float(os.getenv("PERSONAL_LLM_SUMMARY_SHARE", 0.25))
+
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation between a user and an AI assistant.\n"
+    "Keep names, numbers, decisions and open questions. Write in the language of the conversation.\n"
+    "Answer with the summary only, in at most {max_words} words.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New messages:\n{messages}\n"
+)
+
+
+class RollingSummaryMemory(ChatMemoryBuffer):
+    """
+    Token-budgeted conversation memory.
+    token_limit bounds the whole prompt: the caller passes what the rest of it takes (system
+    prompt, retrieved context, the new message) as initial_token_count, and the history gets
+    what is left. Recent turns are sent verbatim; turns that no longer fit the budget are folded into a
+    running summary by a background thread, so a turn never waits on summarization.
+    Until the summary catches up, overflowing turns are simply left out.
+    """
+    summary_llm: Optional[LLM] = Field(default=None, description="LLM used to write the running summary.")
+    summary: str = Field(default="", description="Summary of the turns no longer sent verbatim.")
+    last_prompt_tokens: int = Field(default=0, description="Prompt tokens of the last turn: the initial_token_count (context) plus the history sent.")
+
+    _summarized: int = PrivateAttr(default=0)  # messages from the start already folded into the summary
+    _summarizing: bool = PrivateAttr(default=False)
+    _generation: int = PrivateAttr(default=0)  # bumped on reset, so a stale summary is discarded
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls):
+        return "RollingSummaryMemory"
+
+    @classmethod
+    def from_llm(cls, llm, token_limit):
+        return cls(token_limit=token_limit, summary_llm=llm)
+
+    def _count(self, messages):
+        return sum(len(self.tokenizer_fn(str(m.content or ""))) for m in messages)
+
+    def get(self, input=None, initial_token_count=0, **kwargs):
+        messages = self.get_all()
+        with self._lock:
+            summarized = self._summarized
+            summary = self.summary
+
+        summary_messages = []
+        if summary:
+            summary_messages = [ChatMessage(
+                role=MessageRole.SYSTEM,
+                content=f"Summary of the earlier conversation:\n{summary}",
+            )]
+        budget = self.token_limit - initial_token_count - self._count(summary_messages)
+
+        # Walk back from the newest message while the budget holds
+        start = len(messages)
+        used = 0
+        while start > summarized:
+            cost = self._count(messages[start - 1:start])
+            if used + cost > budget:
+                break
+            used += cost
+            start -= 1
+        # Never open the verbatim window with an assistant reply cut off from its question
+        while start < len(messages) and messages[start].role != MessageRole.USER:
+            start += 1
+
+        if start > summarized:
+            self._summarize_in_background(messages[summarized:start], start)
+
+        history = summary_messages + messages[start:]
+        self.last_prompt_tokens = initial_token_count + self._count(history)
+        return history
+
+    def _summarize_in_background(self, messages, upto):
+        if self.summary_llm is None:
+            return
+        with self._lock:
+            if self._summarizing:
+                return
+            self._summarizing = True
+            generation = self._generation
+        threading.Thread(target=self._summarize, args=(messages, upto, generation), daemon=True).start()
+
+    def _summarize(self, messages, upto, generation):
+        try:
+            transcript = "\n".join(f"{m.role.value}: {m.content}" for m in messages)
+            prompt = SUMMARY_PROMPT.format(
+                max_words=max(50, int(self.token_limit * SUMMARY_SHARE * 0.75)),
+                summary=self.summary or "(none)",
+                messages=transcript,
+            )
+            summary = str(self.summary_llm.complete(prompt)).strip()
+            with self._lock:
+                if generation != self._generation:
+                    return
+                self.summary = summary
+                self._summarized = upto
+            logger.info(f"Conversation summary updated ({upto} messages folded in).")
+        except Exception as e:
+            # Keep the old summary; the next turn will try again
+            logger.warning(f"Conversation summarization failed: {e}")
+        finally:
+            with self._lock:
+                self._summarizing = False
+
+    def reset(self):
+        super().reset()
+        with self._lock:
+            self.summary = ""
+            self._summarized = 0
+            self._generation += 1
+        self.last_prompt_tokens = 0
+
+
+class BudgetedContextChatEngine(ContextChatEngine):
+    """
+    ContextChatEngine that counts the prompt it builds (system prompt, retrieved context and
+    the new message) against the memory's token budget, the way SimpleChatEngine counts its
+    prefix messages. The stock engine asks its memory for history without it, so retrieved
+    chunks were neither budgeted nor reported in last_prompt_tokens.
+    """
+
+    def _prompt_tokens(self, message, nodes):
+        context_str = "\n\n".join(n.node.get_content(metadata_mode=MetadataMode.LLM).strip() for n in nodes)
+        texts = [self._context_template.format(context_str=context_str), message]
+        texts += [str(m.content or "") for m in self._prefix_messages]
+        return len(self._memory.tokenizer_fn(" ".join(texts)))
+
+    def _sources(self, message, nodes):
+        return [ToolOutput(tool_name="retriever", content=str(nodes), raw_input={"message": message}, raw_output=nodes)]
+
+    def chat(self, message, chat_history=None, prev_chunks=None):
+        if chat_history is not None:
+            self._memory.set(chat_history)
+        nodes = self._get_nodes(message) or prev_chunks or []
+        history = self._memory.get(input=message, initial_token_count=self._prompt_tokens(message, nodes))
+        response = self._get_response_synthesizer(history).synthesize(message, nodes)
+        self._memory.put(ChatMessage(content=str(message), role=MessageRole.USER))
+        self._memory.put(ChatMessage(content=str(response), role=MessageRole.ASSISTANT))
+        return AgentChatResponse(response=str(response), sources=self._sources(message, nodes), source_nodes=nodes)
+
+    def stream_chat(self, message, chat_history=None, prev_chunks=None):
+        if chat_history is not None:
+            self._memory.set(chat_history)
+        nodes = self._get_nodes(message) or prev_chunks or []
+        history = self._memory.get(input=message, initial_token_count=self._prompt_tokens(message, nodes))
+        response = self._get_response_synthesizer(history, streaming=True).synthesize(message, nodes)
+        assert isinstance(response, StreamingResponse)
+        self._memory.put(ChatMessage(content=str(message), role=MessageRole.USER))
+
+        def wrapped_gen():
+            full_response = ""
+            for token in response.response_gen:
+                full_response += token
+                yield ChatResponse(message=ChatMessage(content=full_response, role=MessageRole.ASSISTANT), delta=token)
+
+        chat_response = StreamingAgentChatResponse(
+            chat_stream=wrapped_gen(), sources=self._sources(message, nodes), source_nodes=nodes
+        )
+        thread = Thread(target=chat_response.write_response_to_history, args=(self._memory,))
+        chat_response.write_response_to_history_thread = thread
+        thread.start()
+        return chat_response
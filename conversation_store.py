@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Next to the app, like the index store, so conversations survive restarts
+DEFAULT_HISTORY_PATH = os.getenv(
+    "PERSONAL_LLM_HISTORY_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".history.sqlite3"),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL DEFAULT '',
+    title TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    file_hashes TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+) WITHOUT ROWID;
+"""
+
+# After the owner migration, which older databases need before the index can exist
+OWNER_INDEX = "CREATE INDEX IF NOT EXISTS conversations_by_owner ON conversations (owner, updated_at DESC, id)"
+
+TITLE_LENGTH = 60
+
+
+class ConversationStore:
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        """
+        SQLite store of conversations, their messages and the files (content hashes) they were
+        indexed against. Every conversation belongs to an owner (one browser, see app.py), and
+        every lookup is filtered by it, so visitors never see each other's chats.
+        WAL mode lets sessions read while another one writes. Listing and message loading are
+        keyset-paginated over indexes, so opening a chat only reads the page being shown,
+        however many conversations and messages are stored.
+        """
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as db:
+            db.executescript(SCHEMA)
+            columns = {row["name"] for row in db.execute("PRAGMA table_info(conversations)")}
+            if "owner" not in columns:
+                # Chats saved before owners existed stay unowned, and so hidden from everyone
+                db.execute("ALTER TABLE conversations ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            db.execute("DROP INDEX IF EXISTS conversations_by_update")
+            db.execute(OWNER_INDEX)
+
+    def _connection(self):
+        # sqlite3 connections can't be shared across threads; Streamlit runs each session on its own
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA foreign_keys=ON")
+            self._local.db = db
+        return db
+
+    def create(self, owner, title="New chat", file_hashes=()):
+        if not owner:
+            raise ValueError("A conversation needs an owner.")
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connection() as db:
+            db.execute(
+                "INSERT INTO conversations (id, owner, title, created_at, updated_at, file_hashes) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, owner, title[:TITLE_LENGTH], now, now, json.dumps(sorted(file_hashes))),
+            )
+        return conversation_id
+
+    def get(self, owner, conversation_id):
+        row = self._connection().execute(
+            "SELECT * FROM conversations WHERE id = ? AND owner = ?", (conversation_id, owner)
+        ).fetchone()
+        return self._conversation(row) if row else None
+
+    def list(self, owner, limit=20, before=None):
+        """
+        The owner's most recently updated conversations first. Pass the last one returned
+        as before to get the next page.
+        """
+        if before is None:
+            rows = self._connection().execute(
+                "SELECT * FROM conversations WHERE owner = ? ORDER BY updated_at DESC, id LIMIT ?",
+                (owner, limit),
+            ).fetchall()
+        else:
+            rows = self._connection().execute(
+                "SELECT * FROM conversations WHERE owner = ? AND (updated_at < ? OR (updated_at = ? AND id > ?)) "
+                "ORDER BY updated_at DESC, id LIMIT ?",
+                (owner, before["updated_at"], before["updated_at"], before["id"], limit),
+            ).fetchall()
+        return [self._conversation(row) for row in rows]
+
+    def delete(self, owner, conversation_id):
+        with self._connection() as db:
+            db.execute("DELETE FROM conversations WHERE id = ? AND owner = ?", (conversation_id, owner))
+
+    def append(self, owner, conversation_id, role, content, prompt_tokens=0):
+        """
+        Adds a message at the end of one of the owner's conversations and returns its position (seq).
+        """
+        now = time.time()
+        with self._connection() as db:
+            updated = db.execute(
+                "UPDATE conversations SET message_count = message_count + 1, updated_at = ? "
+                "WHERE id = ? AND owner = ?",
+                (now, conversation_id, owner),
+            )
+            if updated.rowcount == 0:
+                raise KeyError(f"Unknown conversation {conversation_id}")
+            seq = db.execute(
+                "SELECT message_count - 1 FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()[0]
+            db.execute(
+                "INSERT INTO messages (conversation_id, seq, role, content, prompt_tokens, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, seq, role, content, prompt_tokens, now),
+            )
+        return seq
+
+    def messages(self, owner, conversation_id, limit=40, before=None):
+        """
+        The latest limit messages of one of the owner's conversations (oldest first),
+        or the ones just before seq before, to page further back.
+        """
+        rows = self._connection().execute(
+            "SELECT m.seq, m.role, m.content, m.prompt_tokens FROM messages m "
+            "JOIN conversations c ON c.id = m.conversation_id "
+            "WHERE m.conversation_id = ? AND c.owner = ? AND m.seq < ? ORDER BY m.seq DESC LIMIT ?",
+            (conversation_id, owner, before if before is not None else 2 ** 62, limit),
+        ).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def bind_files(self, owner, conversation_id, file_hashes):
+        """
+        Records the files (by content hash) the conversation's answers are grounded in.
+        """
+        with self._connection() as db:
+            db.execute(
+                "UPDATE conversations SET file_hashes = ? WHERE id = ? AND owner = ?",
+                (json.dumps(sorted(file_hashes)), conversation_id, owner),
+            )
+
+    @staticmethod
+    def _conversation(row):
+        conversation = dict(row)
+        conversation["file_hashes"] = json.loads(conversation["file_hashes"])
+        return conversation
+
+
+CONVERSATIONS = ConversationStore()
@@ -0,0 +1,132 @@
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metrics import METRICS
+from inference_worker import EMBED_BATCHER
+
+logger = logging.getLogger(__name__)
+
+# Per-provider defaults. Groq has no embeddings of its own and goes through Gemini,
+# so it shares Gemini's quota. Ollama is local: no request cap, just a worker limit.
+PROVIDER_LIMITS = {
+    "gemini": {"batch_size": 32, "max_workers": 4, "requests_per_minute": 1500},
+    "groq": {"batch_size": 32, "max_workers": 4, "requests_per_minute": 1500},
+    "ollama": {"batch_size": 16, "max_workers": 2, "requests_per_minute": None},
+}
+
+RATE_LIMIT_MARKERS = ("429", "rate limit", "ratelimit", "quota", "resource exhausted", "resourceexhausted", "too many requests")
+
+
+def is_rate_limit_error(error):
+    """
+    Best-effort check for a provider's "slow down" error (HTTP 429, quota exceeded, ...).
+    """
+    text = f"{type(error).__name__} {error}".lower()
+    return any(marker in text for marker in RATE_LIMIT_MARKERS)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None):
+        """
+        Spaces request starts to stay under a requests-per-minute quota, and lets
+        any worker that hits a 429 pause all the others until the backoff expires.
+        """
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.next_slot = 0.0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot, self.blocked_until)
+            self.next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def back_off(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+# One limiter per provider, shared by every session in the process, since the quota is per key/host.
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider):
+    with _limiters_lock:
+        if provider not in _limiters:
+            limits = PROVIDER_LIMITS.get(provider, {})
+            _limiters[provider] = RateLimiter(limits.get("requests_per_minute"))
+        return _limiters[provider]
+
+
+class EmbeddingPipeline:
+    def __init__(self, embed_model, provider="ollama", batch_size=None, max_workers=None, max_retries=5):
+        """
+        Embeds texts in batches on a bounded pool of worker threads.
+        Batch size and worker count default per provider and can be overridden with
+        PERSONAL_LLM_EMBED_BATCH_SIZE / PERSONAL_LLM_EMBED_WORKERS.
+        """
+        limits = PROVIDER_LIMITS.get(provider, PROVIDER_LIMITS["ollama"])
+        self.embed_model = embed_model
+        self.provider = provider
+        self.batch_size = batch_size or int(os.getenv("PERSONAL_LLM_EMBED_BATCH_SIZE", limits["batch_size"]))
+        self.max_workers = max_workers or int(os.getenv("PERSONAL_LLM_EMBED_WORKERS", limits["max_workers"]))
+        self.max_retries = max_retries
+        self.rate_limiter = get_rate_limiter(provider)
+        self.last_stats = None
+
+    def _embed_batch(self, texts):
+        delay = 2.0
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                # Partial batches are merged with concurrent ones for the same model from other sessions
+                return EMBED_BATCHER.embed(
+                    self.embed_model, texts, max_batch=self.batch_size, caller=id(self), max_workers=self.max_workers
+                )
+            except Exception as e:
+                if attempt == self.max_retries or not is_rate_limit_error(e):
+                    raise
+                # Exponential backoff with jitter; blocks the other workers too
+                wait = min(delay, 60.0) * (1 + random.random() * 0.25)
+                logger.warning(f"{self.provider} embedding rate-limited, retrying in {wait:.1f}s")
+                self.rate_limiter.back_off(wait)
+                delay *= 2
+
+    def embed(self, texts):
+        """
+        Returns one embedding per text, in input order.
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+
+        start = time.perf_counter()
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1 or self.max_workers <= 1:
+            results = [self._embed_batch(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+                results = list(pool.map(self._embed_batch, batches))
+        elapsed = time.perf_counter() - start
+        METRICS.observe("embed", elapsed, provider=self.provider, model=self.embed_model.model_name)
+
+        embeddings = [embedding for batch in results for embedding in batch]
+        self.last_stats = {
+            "chunks": len(texts),
+            "batches": len(batches),
+            "seconds": elapsed,
+            "chunks_per_sec": len(texts) / elapsed if elapsed > 0 else float("inf"),
+        }
+        logger.info(
+            f"Embedded {len(texts)} chunks in {elapsed:.2f}s "
+            f"({self.last_stats['chunks_per_sec']:.1f} chunks/sec, {self.provider})"
+        )
+        return embeddings
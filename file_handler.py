@@ -1,41 +1,289 @@
 import os
+import io
+import hashlib
+import logging
+import mimetypes
+import time
 import tempfile
+import multiprocessing
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from llama_index.core import SimpleDirectoryReader, Document
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Formats we can parse straight from the upload buffer, without a temp file
+TEXT_EXTENSIONS = {".txt", ".md", ".csv", ".json", ".html", ".xml", ".log"}
+
+# Same keys SimpleDirectoryReader hides from embeddings and the LLM prompt
+HIDDEN_METADATA_KEYS = ["file_name", "file_type", "file_size", "file_hash"]
+
+# Uploads above this size are spooled to disk and parsed incrementally (PDFs page by page,
+# CSV and text files in batches of lines) instead of being copied whole into a worker process.
+LARGE_FILE_BYTES = int(os.getenv("PERSONAL_LLM_LARGE_FILE_MB", 20)) * 1024 * 1024
+# Text per Document when streaming CSV and text files, and per write when spooling
+STREAM_BATCH_BYTES = 1024 * 1024
+
+
+def _parse_pdf(data):
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    return [
+        (page.extract_text() or "", {"page_label": reader.page_labels[i]})
+        for i, page in enumerate(reader.pages)
+    ]
+
+
+def _parse_docx(data):
+    import docx2txt
+    return [(docx2txt.process(io.BytesIO(data)), {})]
+
+
+def _parse_with_reader(file_name, data):
+    # Fallback for formats only SimpleDirectoryReader knows; the temp dir is removed afterwards.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, file_name)
+        with open(file_path, "wb") as f:
+            f.write(data)
+        documents = SimpleDirectoryReader(input_files=[file_path]).load_data()
+    return [
+        (doc.text, {k: v for k, v in doc.metadata.items() if k == "page_label"})
+        for doc in documents
+    ]
+
+
+def parse_file(file_name, data):
+    """
+    Parses one file's bytes into (text, metadata) pairs.
+    Runs inside a worker process, so it only returns plain picklable data.
+    """
+    extension = Path(file_name).suffix.lower()
+    if extension == ".pdf":
+        sections = _parse_pdf(data)
+    elif extension == ".docx":
+        sections = _parse_docx(data)
+    elif extension in TEXT_EXTENSIONS:
+        sections = [(data.decode("utf-8", errors="replace"), {})]
+    else:
+        sections = _parse_with_reader(file_name, data)
+
+    base_metadata = {
+        "file_name": file_name,
+        "file_type": mimetypes.guess_type(file_name)[0] or "",
+        "file_size": len(data),
+    }
+    return [(text, {**base_metadata, **metadata}) for text, metadata in sections]
+
+
+def _spool(uploaded_file, directory):
+    """
+    Writes an upload to disk piece by piece, hashing it on the way. Returns (path, content hash).
+    """
+    path = os.path.join(directory, Path(uploaded_file.name).name)
+    digest = hashlib.sha256()
+    with uploaded_file.getbuffer() as view, open(path, "wb") as f:
+        for start in range(0, len(view), STREAM_BATCH_BYTES):
+            piece = view[start:start + STREAM_BATCH_BYTES]
+            digest.update(piece)
+            f.write(piece)
+    return path, digest.hexdigest()
+
+
+def _stream_pdf(path):
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    labels = reader.page_labels
+    for i, page in enumerate(reader.pages):
+        yield [(page.extract_text() or "", {"page_label": labels[i]})], (i + 1) / len(labels)
+
+
+def _stream_lines(path, repeat_header):
+    # Batches end on line boundaries, so multi-byte characters are never cut in half.
+    # CSV batches repeat the header row so every chunk keeps its column names.
+    size = os.path.getsize(path) or 1
+    with open(path, "rb") as f:
+        header = f.readline() if repeat_header else b""
+        batch, batch_bytes = [header], len(header)
+        yielded = False
+        for line in f:
+            batch.append(line)
+            batch_bytes += len(line)
+            if batch_bytes >= STREAM_BATCH_BYTES:
+                yield [(b"".join(batch).decode("utf-8", errors="replace"), {})], f.tell() / size
+                yielded = True
+                batch, batch_bytes = [header], len(header)
+        # A header-only CSV is still a file: its header is the one section
+        if len(batch) > 1 or (not yielded and header.strip()):
+            yield [(b"".join(batch).decode("utf-8", errors="replace"), {})], 1.0
+
+
+def iter_file_sections(path, file_name):
+    """
+    Streaming counterpart of parse_file for a file on disk: yields (sections, fraction done)
+    one page or batch of lines at a time. Other formats are still parsed in one go.
+    """
+    extension = Path(file_name).suffix.lower()
+    if extension == ".pdf":
+        batches = _stream_pdf(path)
+    elif extension in TEXT_EXTENSIONS:
+        batches = _stream_lines(path, repeat_header=extension == ".csv")
+    elif extension == ".docx":
+        import docx2txt
+        batches = iter([([(docx2txt.process(path), {})], 1.0)])
+    else:
+        documents = SimpleDirectoryReader(input_files=[path]).load_data()
+        sections = [(doc.text, {k: v for k, v in doc.metadata.items() if k == "page_label"}) for doc in documents]
+        batches = iter([(sections, 1.0)])
+
+    base_metadata = {
+        "file_name": file_name,
+        "file_type": mimetypes.guess_type(file_name)[0] or "",
+        "file_size": os.path.getsize(path),
+    }
+    for sections, fraction in batches:
+        yield [(text, {**base_metadata, **metadata}) for text, metadata in sections], fraction
+
+
+def timed_parse_file(file_name, data):
+    """
+    parse_file plus its wall time, so the parent process can record the "parse" span.
+    """
+    start = time.perf_counter()
+    sections = parse_file(file_name, data)
+    return sections, time.perf_counter() - start
+
+
+def _record_parse(file_name, seconds, tags):
+    METRICS.observe("parse", seconds, file_type=Path(file_name).suffix.lower() or "none", **tags)
+
 
 class FileHandler:
     @staticmethod
     def process_uploaded_files(uploaded_files):
         """
-        Takes Streamlit UploadedFile objects, saves them temporarily, 
-        and uses LlamaIndex Reader to load them as Documents.
+        Takes Streamlit UploadedFile objects and loads them as Documents.
+        Thin wrapper over iter_documents for callers that want a list.
         """
-        documents = []
-        temp_dir = tempfile.mkdtemp()
-        
-        file_paths = []
-        
+        return list(FileHandler.iter_documents(uploaded_files))
+
+    @staticmethod
+    def iter_documents(uploaded_files, max_workers=None, on_progress=None, **tags):
+        """
+        Parses uploads in a process pool (PDF/DOCX parsing is CPU-bound) and yields
+        Documents as each file finishes, so indexing can start before the last file is parsed.
+        Files over LARGE_FILE_BYTES are streamed instead, see _stream_large_file.
+        A file's Documents are always yielded together.
+        on_progress(file_name, fraction) is called as each file advances.
+        tags (the provider and model the files are parsed for) are added to the "parse" spans.
+        Closing the generator early (e.g. a cancelled upload) stops pending work and
+        removes temporary files.
+        """
+        # Each upload carries its own hash: two files may share a name but not their content
+        uploads = []
+        large_files = []
+        for uploaded_file in uploaded_files:
+            if uploaded_file.size > LARGE_FILE_BYTES:
+                large_files.append(uploaded_file)
+                continue
+            data = uploaded_file.getvalue()
+            uploads.append((uploaded_file.name, data, FileHandler.content_hash(data)))
+
+        def report(file_name, fraction):
+            if on_progress:
+                on_progress(file_name, fraction)
+
+        max_workers = max_workers or min(len(uploads), os.cpu_count() or 1)
+        pool = None
+        if max_workers > 1 and len(uploads) > 1:
+            # Spawned, not forked: a fork of the threaded Streamlit server could inherit a lock
+            # held by another thread (logging, the inference worker) and hang forever
+            pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
         try:
-            for uploaded_file in uploaded_files:
-                file_path = os.path.join(temp_dir, uploaded_file.name)
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                file_paths.append(file_path)
-            
-            # Use SimpleDirectoryReader to load the files
-            # It handles PDF, DOCX, TXT, etc. automatically if libs are installed.
-            reader = SimpleDirectoryReader(input_dir=temp_dir)
-            documents = reader.load_data()
-            
-            return documents
-        except Exception as e:
-            raise e
+            # Small files parse in the pool while the large ones stream here
+            futures = {}
+            if pool:
+                futures = {
+                    pool.submit(timed_parse_file, file_name, data): (file_name, file_hash)
+                    for file_name, data, file_hash in uploads
+                }
+                uploads = []
+
+            for uploaded_file in large_files:
+                yield from FileHandler._stream_large_file(uploaded_file, report, tags)
+
+            # Not worth spinning up a pool for a single file
+            for file_name, data, file_hash in uploads:
+                sections, seconds = timed_parse_file(file_name, data)
+                _record_parse(file_name, seconds, tags)
+                yield from FileHandler._to_documents(sections, file_hash)
+                report(file_name, 1.0)
+
+            for future in as_completed(futures):
+                file_name, file_hash = futures[future]
+                sections, seconds = future.result()
+                logger.info(f"Parsed {file_name} in {seconds:.2f}s")
+                _record_parse(file_name, seconds, tags)
+                yield from FileHandler._to_documents(sections, file_hash)
+                report(file_name, 1.0)
         finally:
-            # Cleanup optionally? For now, temp dir persists until OS cleanup 
-            # or we could delete it, but LlamaIndex might lazy load?
-            # Usually strict cleanup is good, but for now let's just leave it 
-            # as safe within the run duration.
-            pass
+            if pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _stream_large_file(uploaded_file, report, tags):
+        """
+        Spools one upload to a temp file and yields its Documents a page or batch at a time,
+        so only the batch being parsed is held as text.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path, file_hash = _spool(uploaded_file, temp_dir)
+            batches = iter_file_sections(path, uploaded_file.name)
+            position = 0
+            seconds = 0.0
+            while True:
+                start = time.perf_counter()
+                batch = next(batches, None)
+                seconds += time.perf_counter() - start
+                if batch is None:
+                    break
+                sections, fraction = batch
+                documents = FileHandler._to_documents(sections, file_hash, start=position)
+                position += len(documents)
+                yield from documents
+                report(uploaded_file.name, fraction)
+            logger.info(f"Streamed {uploaded_file.name} ({position} parts) in {seconds:.2f}s of parsing")
+            _record_parse(uploaded_file.name, seconds, tags)
+
+    @staticmethod
+    def _to_documents(sections, file_hash, start=0):
+        documents = []
+        for text, metadata in sections:
+            doc = Document(text=text, metadata=metadata)
+            doc.excluded_embed_metadata_keys.extend(HIDDEN_METADATA_KEYS)
+            doc.excluded_llm_metadata_keys.extend(HIDDEN_METADATA_KEYS)
+            documents.append(doc)
+        FileHandler.tag_documents(documents, file_hash, start=start)
+        return documents
+
+    @staticmethod
+    def content_hash(data):
+        """
+        SHA-256 of the raw file bytes (any bytes-like object, e.g. UploadedFile.getbuffer()).
+        Used as the cache key for embedded nodes.
+        """
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def tag_documents(documents, file_hash, start=0):
+        """
+        Stamps one file's Documents with its content hash and gives each a stable ID,
+        so the same file always maps to the same nodes across sessions.
+        start is the position of the first Document when a file is tagged in batches.
+        """
+        for position, doc in enumerate(documents, start):
+            doc.metadata["file_hash"] = file_hash
+            doc.id_ = f"{file_hash}:{position}"
 
     @staticmethod
     def read_text_file(file_path):
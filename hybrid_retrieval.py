@@ -0,0 +1,191 @@
+import re
+import math
+import logging
+from collections import Counter, defaultdict
+from typing import Any, Optional
+import numpy as np
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore
+
+logger = logging.getLogger(__name__)
+
+# \w alone splits Indic words at their vowel signs (combining marks aren't alphanumeric),
+# so the Devanagari..Sinhala blocks are matched as a whole.
+TOKEN_PATTERN = re.compile(r"[\w\u0900-\u0DFF]+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+class BM25Index:
+    def __init__(self, nodes, k1=1.5, b=0.75):
+        """
+        In-memory Okapi BM25 keyword index over a set of nodes.
+        Complements dense retrieval on exact terms (names, numbers, rare words) that
+        embeddings tend to blur, especially outside English.
+        """
+        self.k1 = k1
+        self.b = b
+        self.nodes = []
+        self.doc_lengths = []
+        self.postings = defaultdict(list)  # term -> [(node position, term frequency)]
+
+        for node in nodes:
+            terms = Counter(tokenize(node.get_content(metadata_mode=MetadataMode.NONE)))
+            position = len(self.nodes)
+            self.nodes.append(node)
+            self.doc_lengths.append(sum(terms.values()))
+            for term, freq in terms.items():
+                self.postings[term].append((position, freq))
+
+        self.avg_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0.0
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def search(self, query, top_k=10):
+        """
+        Returns up to top_k (node, score) pairs, best first.
+        """
+        if not self.nodes:
+            return []
+
+        n = len(self.nodes)
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, freq in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[position] / self.avg_length)
+                scores[position] += idf * freq * (self.k1 + 1) / (freq + norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [(self.nodes[position], score) for position, score in best]
+
+
+def lexical_overlap(query, texts):
+    """
+    Share of the query's terms found in each text, each term weighted by how rare it is
+    among the texts: a matching ID or name counts for more than a word every text contains.
+    """
+    query_terms = set(tokenize(query))
+    text_terms = [set(tokenize(text)) & query_terms for text in texts]
+    # Terms no candidate contains can't tell them apart, so they don't count
+    doc_freq = Counter(term for terms in text_terms for term in terms)
+    if not doc_freq:
+        return np.zeros(len(texts), dtype=np.float32)
+    weights = {term: math.log(1 + (len(texts) + 1) / (freq + 0.5)) for term, freq in doc_freq.items()}
+    total = sum(weights.values())
+    return np.asarray([sum(weights[term] for term in terms) / total for terms in text_terms], dtype=np.float32)
+
+
+class EmbeddingReranker(BaseNodePostprocessor):
+    """
+    Local reranking stage. Each candidate's score blends its incoming (fused) score, scaled to
+    the best candidate's, with the query's weighted term overlap and its cosine similarity to
+    the query, and the top_n are kept. The fused score leads, so keyword hits the embeddings
+    missed (exact names, numbers, non-English terms) aren't ranked out by the signal that
+    missed them. Embeddings are read from the index's vector store; candidates are only
+    re-embedded if it can't return them.
+    """
+    embed_model: BaseEmbedding = Field(description="Embedding model used to build the index.")
+    top_n: int = Field(default=3, description="Number of nodes to keep.")
+    vector_store: Optional[Any] = Field(
+        default=None, description="Vector store to read embeddings from (docstore nodes have none)."
+    )
+    fused_weight: float = Field(default=0.5, description="Weight of the incoming (fused) score.")
+    lexical_weight: float = Field(default=0.3, description="Weight of the query term overlap.")
+
+    @classmethod
+    def class_name(cls):
+        return "EmbeddingReranker"
+
+    def _stored_embeddings(self, node_ids):
+        # MmapVectorStore reads rows in one go; SimpleVectorStore (the in-RAM store) one id at a time
+        if hasattr(self.vector_store, "get_embeddings"):
+            return self.vector_store.get_embeddings(node_ids)
+        embeddings = []
+        for node_id in node_ids:
+            try:
+                embeddings.append(self.vector_store.get(node_id))
+            except (AttributeError, KeyError, NotImplementedError):
+                embeddings.append(None)
+        return embeddings
+
+    def _similarities(self, nodes, query_bundle):
+        query_embedding = query_bundle.embedding or self.embed_model.get_query_embedding(query_bundle.query_str)
+
+        embeddings = [n.node.embedding or None for n in nodes]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            stored = self._stored_embeddings([nodes[i].node.node_id for i in missing])
+            for i, embedding in zip(missing, stored):
+                embeddings[i] = embedding
+            missing = [i for i in missing if embeddings[i] is None]
+        if missing:
+            # Last resort: a vector store that can't hand embeddings back
+            texts = [nodes[i].node.get_content(metadata_mode=MetadataMode.EMBED) for i in missing]
+            for i, embedding in zip(missing, self.embed_model.get_text_embedding_batch(texts)):
+                embeddings[i] = embedding
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+        return matrix @ query / np.where(norms == 0, 1.0, norms)
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        if not nodes or query_bundle is None:
+            return nodes[: self.top_n]
+
+        fused = np.asarray([n.score or 0.0 for n in nodes], dtype=np.float32)
+        if fused.max() > 0:
+            fused /= fused.max()
+        texts = [n.node.get_content(metadata_mode=MetadataMode.NONE) for n in nodes]
+        scores = (
+            self.fused_weight * fused
+            + self.lexical_weight * lexical_overlap(query_bundle.query_str, texts)
+            + (1.0 - self.fused_weight - self.lexical_weight) * self._similarities(nodes, query_bundle)
+        )
+
+        # Stable, so ties keep the fused order
+        order = np.argsort(-scores, kind="stable")[: self.top_n]
+        return [NodeWithScore(node=nodes[i].node, score=float(scores[i])) for i in order]
+
+
+class HybridRetriever(BaseRetriever):
+    def __init__(self, vector_retriever, bm25_index, reranker, candidate_top_k=10, rrf_k=60):
+        """
+        Fuses dense (vector) and BM25 keyword results with reciprocal rank fusion,
+        then hands the fused candidates (scored by fusion) to the reranker, which trims them to its top_n.
+        """
+        super().__init__()
+        self.vector_retriever = vector_retriever
+        self.bm25_index = bm25_index
+        self.reranker = reranker
+        self.candidate_top_k = candidate_top_k
+        self.rrf_k = rrf_k
+
+    def _retrieve(self, query_bundle):
+        # The vector retriever fills in query_bundle.embedding, which the reranker then reuses.
+        dense = self.vector_retriever.retrieve(query_bundle)
+        sparse = self.bm25_index.search(query_bundle.query_str, top_k=self.candidate_top_k)
+
+        fused = {}
+        scores = defaultdict(float)
+        for ranking in ([n.node for n in dense], [node for node, _ in sparse]):
+            for rank, node in enumerate(ranking):
+                fused.setdefault(node.node_id, node)
+                scores[node.node_id] += 1.0 / (self.rrf_k + rank + 1)
+
+        candidates = [
+            NodeWithScore(node=fused[node_id], score=score)
+            for node_id, score in sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        ][: self.candidate_top_k]
+        logger.debug(f"Hybrid retrieval: {len(dense)} dense + {len(sparse)} keyword -> {len(candidates)} candidates.")
+        return self.reranker.postprocess_nodes(candidates, query_bundle=query_bundle)
@@ -0,0 +1,147 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from hybrid_retrieval import BM25Index
+
+logger = logging.getLogger(__name__)
+
+
+class IndexEntry:
+    """
+    A VectorStoreIndex shared by every session whose document set matches its key.
+    files maps content hash -> ref_doc_ids, as LLMEngine.indexed_files.
+    """
+    def __init__(self, key, index, files, size_bytes):
+        self.key = key
+        self.index = index
+        self.files = files
+        self.size_bytes = size_bytes
+        self.refs = 0
+        self._bm25 = None
+        self._bm25_lock = threading.Lock()
+
+    def bm25(self):
+        """
+        BM25 keyword index over this entry's nodes, built once and shared like the index itself.
+        """
+        with self._bm25_lock:
+            if self._bm25 is None:
+                self._bm25 = BM25Index(self.index.docstore.docs.values())
+            return self._bm25
+
+
+class IndexRegistry:
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        """
+        Process-wide registry of document indexes, keyed by embedding model + store settings +
+        corpus fingerprint, so sessions that upload the same files attach to one index.
+        Entries are reference counted; unreferenced ones stay around for reuse and are
+        evicted least-recently-used once the estimated total size exceeds max_bytes.
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+        Returns the entry for key with one more reference, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            entry.refs += 1
+            logger.info(f"Attached to shared index ({entry.refs} sessions).")
+            return entry
+
+    def add(self, entry):
+        """
+        Registers a newly built entry (with one reference) unless another session got there
+        first, in which case that entry is returned instead.
+        """
+        with self._lock:
+            existing = self._entries.get(entry.key)
+            if existing is not None:
+                existing.refs += 1
+                self._entries.move_to_end(entry.key)
+                return existing
+            entry.refs = 1
+            self._entries[entry.key] = entry
+            self._evict()
+            return entry
+
+    def detach(self, entry):
+        """
+        Takes an entry out of the registry if the caller holds its only reference,
+        so it can be modified in place. Returns whether that happened.
+        """
+        with self._lock:
+            if entry.refs != 1 or self._entries.get(entry.key) is not entry:
+                return False
+            del self._entries[entry.key]
+            entry.refs = 0
+            return True
+
+    def release(self, entry):
+        with self._lock:
+            entry.refs = max(0, entry.refs - 1)
+            self._evict()
+
+    def _evict(self):
+        total = sum(entry.size_bytes for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry.refs == 0:
+                del self._entries[key]
+                total -= entry.size_bytes
+                logger.info(f"Evicted shared index ({entry.size_bytes / 1e6:.1f} MB).")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "indexes": len(self._entries),
+                "in_use": sum(1 for entry in self._entries.values() if entry.refs),
+                "mb": sum(entry.size_bytes for entry in self._entries.values()) / 1e6,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+INDEXES = IndexRegistry(max_bytes=int(os.getenv("PERSONAL_LLM_INDEX_CACHE_MB", 512)) * 1024 * 1024)
+
+
+class IndexLease:
+    """
+    An engine's hold on a registry entry. Released when the engine is garbage collected
+    (Streamlit drops session_state when a session ends), see LLMEngine.
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self.entry = None
+
+    def swap(self, entry):
+        previous, self.entry = self.entry, entry
+        if previous is not None and previous is not entry:
+            self.registry.release(previous)
+
+    def release(self):
+        self.swap(None)
+
+
+def estimate_size(nodes, stores_embeddings):
+    """
+    Rough resident size of an index over these nodes: text (kept by the docstore and BM25),
+    per-node overhead, and the embeddings when they are held in RAM.
+    """
+    size = 0
+    for node in nodes:
+        size += 2 * len(node.get_content()) + 2048
+        if stores_embeddings and node.embedding is not None:
+            size += 32 * len(node.embedding)  # a list of Python floats
+    return size
@@ -0,0 +1,247 @@
+import os
+import re
+import json
+import uuid
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from itertools import groupby
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Lives next to the app so every Streamlit session (and restart) shares it.
+DEFAULT_INDEX_DIR = os.getenv(
+    "PERSONAL_LLM_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".index_store"),
+)
+
+# Upper bound on Document text chunked and embedded at once; large files arrive as many
+# Documents (pages, row batches) and are processed in slices so their text is never all in memory.
+BUILD_BATCH_CHARS = 4 * 1024 * 1024
+# Nodes handled at once when streaming a cached file into a vector segment
+NODE_BATCH = 1024
+
+
+def temp_path(path):
+    """
+    A temp file name next to path, unique to the caller: Streamlit sessions are threads of one
+    process, so a per-process name would be shared by concurrent writers of the same file.
+    """
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+# Per cache entry: [lock, sessions using it]. One session embeds and writes a file while
+# any other that wants the same file waits, then loads what the first one committed.
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _file_lock(path):
+    with _file_locks_lock:
+        entry = _file_locks.setdefault(path, [threading.RLock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _file_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _file_locks[path]
+
+
+def _batches(documents, max_chars):
+    batch, chars = [], 0
+    for doc in documents:
+        batch.append(doc)
+        chars += len(doc.text)
+        if chars >= max_chars:
+            yield batch
+            batch, chars = [], 0
+    if batch:
+        yield batch
+
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _NodeWriter:
+    """
+    Appends nodes to a cache file as JSON lines. Written to a temp file and renamed on commit,
+    so a crash (or a cancelled upload) never leaves half a cache entry behind.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = temp_path(path)
+        self._file = open(self.tmp_path, "w", encoding="utf-8")
+
+    def append(self, nodes):
+        for node in nodes:
+            self._file.write(json.dumps(doc_to_json(node)))
+            self._file.write("\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+
+def drop_embeddings(nodes):
+    """
+    Frees the embeddings of nodes whose vectors are stored in a segment. They keep an empty
+    embedding rather than None, so VectorStoreIndex doesn't embed them again; MmapVectorStore
+    maps the stored rows instead.
+    """
+    for node in nodes:
+        node.embedding = []
+
+
+def document_hash(document):
+    """
+    Returns the content hash a document is cached under.
+    FileHandler stamps 'file_hash' on every Document; anything else falls back to its text.
+    """
+    file_hash = document.metadata.get("file_hash")
+    if file_hash:
+        return file_hash
+    return hashlib.sha256(document.get_content().encode("utf-8")).hexdigest()
+
+
+class IndexStore:
+    def __init__(self, embed_model_key, persist_dir=None):
+        """
+        On-disk cache of embedded nodes.
+        Nodes are stored one JSON file per source file, under a folder per embedding model,
+        so the same PDF is only ever embedded once per model.
+        """
+        self.embed_model_key = embed_model_key
+        self.persist_dir = persist_dir or DEFAULT_INDEX_DIR
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", embed_model_key)
+        self.model_dir = os.path.join(self.persist_dir, slug)
+        os.makedirs(self.model_dir, exist_ok=True)
+
+    def _path(self, file_hash):
+        return os.path.join(self.model_dir, f"{file_hash}.json")
+
+    def has(self, file_hash):
+        return os.path.exists(self._path(file_hash))
+
+    def iter_nodes(self, file_hash):
+        """
+        Yields a file's cached nodes one at a time (one JSON line each), so loading never
+        parses the whole file at once. Caches written as a single JSON array are still read.
+        """
+        with open(self._path(file_hash), "r", encoding="utf-8") as f:
+            if f.read(1) == "[":
+                f.seek(0)
+                yield from (json_to_doc(node) for node in json.load(f))
+                return
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json_to_doc(json.loads(line))
+
+    def load(self, file_hash):
+        return list(self.iter_nodes(file_hash))
+
+    def load_nodes(self, file_hash, segments=None):
+        """
+        A cached file's nodes, ready for indexing. With segments (a SegmentStore), the
+        vectors stay in the file's memory-mapped segment, and the nodes are returned without
+        embeddings (see drop_embeddings). The segment is written first if it is missing, or
+        rewritten from the cache if it holds other nodes than the cache does.
+        """
+        if segments is None:
+            return self.load(file_hash)
+        with _file_lock(self._path(file_hash)):
+            stored_ids = segments.stored_ids(file_hash)
+            if stored_ids is not None:
+                nodes = []
+                for batch in _batched(self.iter_nodes(file_hash), NODE_BATCH):
+                    drop_embeddings(batch)
+                    nodes.extend(batch)
+                if [node.node_id for node in nodes] == stored_ids:
+                    return nodes
+                logger.warning(f"Vector segment of {file_hash} doesn't match its cached nodes, rewriting it.")
+            nodes = []
+            with segments.writer(file_hash) as vectors:
+                for batch in _batched(self.iter_nodes(file_hash), NODE_BATCH):
+                    vectors.append(batch)
+                    drop_embeddings(batch)
+                    nodes.extend(batch)
+            return nodes
+
+    def writer(self, file_hash):
+        return _NodeWriter(self._path(file_hash))
+
+    def save(self, file_hash, nodes):
+        with self.writer(file_hash) as writer:
+            writer.append(nodes)
+
+    def build_nodes(self, documents, embedder, node_parser=None, segments=None, **tags):
+        """
+        Turns Documents (a list or a stream) into embedded nodes.
+        Files already in the store are loaded from disk; only new or changed files go through the embedder
+        (an EmbeddingPipeline).
+        Each slice of a file is written to the cache (and, with segments, to the file's vector
+        segment) as soon as it is embedded. With segments the returned nodes carry no embeddings,
+        so memory doesn't grow with the vectors of a large file.
+        tags (provider and model) are added to the "chunk" spans.
+        """
+        node_parser = node_parser or SentenceSplitter()
+
+        nodes = []
+        seen = set()
+        cached = embedded = 0
+        # Documents arrive grouped by file (FileHandler yields a file's pages together),
+        # so each file can be embedded as soon as it is parsed.
+        for file_hash, docs in groupby(documents, key=document_hash):
+            if file_hash in seen:
+                # Same content uploaded twice under different names
+                continue
+            seen.add(file_hash)
+
+            # A session adding the same file meanwhile waits here, then finds it cached
+            with _file_lock(self._path(file_hash)):
+                if self.has(file_hash):
+                    nodes.extend(self.load_nodes(file_hash, segments))
+                    cached += 1
+                    continue
+
+                # Both committed only once the whole file is in; a failure or cancellation discards them
+                with self.writer(file_hash) as cache, (segments.writer(file_hash) if segments else nullcontext()) as vectors:
+                    for batch in _batches(docs, BUILD_BATCH_CHARS):
+                        with METRICS.span("chunk", **tags):
+                            batch_nodes = node_parser.get_nodes_from_documents(batch)
+                        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch_nodes]
+                        embeddings = embedder.embed(texts)
+                        for node, embedding in zip(batch_nodes, embeddings):
+                            node.embedding = embedding
+                        cache.append(batch_nodes)
+                        if vectors is not None:
+                            vectors.append(batch_nodes)
+                            drop_embeddings(batch_nodes)
+                        nodes.extend(batch_nodes)
+                embedded += 1
+
+        logger.info(f"Index store: {cached} files loaded from disk, {embedded} files embedded.")
+        return nodes
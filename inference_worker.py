@@ -0,0 +1,229 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Concurrent generations per provider. Ollama serves one model on local hardware, so
+# parallel requests only slow each other down; the cloud APIs take a few at once.
+PROVIDER_CONCURRENCY = {"ollama": 1, "gemini": 4, "groq": 4}
+DEFAULT_CONCURRENCY = 2
+
+
+class WorkerBusyError(RuntimeError):
+    """
+    Raised when a provider's request queue is full.
+    """
+
+
+_DONE = object()
+
+
+class _Job:
+    def __init__(self, session_id, provider, generate):
+        self.session_id = session_id
+        self.provider = provider
+        self.generate = generate
+        self.cancelled = False
+        self._output = queue.Queue()
+
+    def run(self):
+        try:
+            for token in self.generate():
+                if self.cancelled:
+                    break
+                self._output.put(token)
+        except Exception as e:
+            self._output.put(e)
+        finally:
+            self._output.put(_DONE)
+
+    def stream(self):
+        """
+        Yields tokens as the worker produces them; re-raises the worker's error, if any.
+        Closing the generator early (e.g. a Streamlit rerun) cancels the job.
+        """
+        try:
+            while True:
+                item = self._output.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.cancelled = True
+
+
+class InferenceWorker:
+    def __init__(self, concurrency=None, default_concurrency=DEFAULT_CONCURRENCY, max_queue=32):
+        """
+        Process-wide scheduler for generation requests from every Streamlit session.
+        Each provider has a concurrency limit and a bounded queue (admission control);
+        within a provider, sessions are served round-robin, so one session sending
+        many requests can't starve the others.
+        """
+        self.concurrency = {**PROVIDER_CONCURRENCY, **(concurrency or {})}
+        self.default_concurrency = default_concurrency
+        self.max_queue = max_queue
+        self._queues = defaultdict(OrderedDict)  # provider -> session_id -> deque of jobs
+        self._active = defaultdict(int)
+        self._cond = threading.Condition()
+        self._dispatcher = None
+
+    def submit(self, session_id, provider, generate):
+        """
+        Queues generate (a callable returning a token iterator) and returns the job;
+        consume its tokens with job.stream().
+        """
+        job = _Job(session_id, provider, generate)
+        with self._cond:
+            sessions = self._queues[provider]
+            if sum(len(jobs) for jobs in sessions.values()) >= self.max_queue:
+                raise WorkerBusyError(f"Too many pending requests for {provider}, try again shortly.")
+            sessions.setdefault(session_id, deque()).append(job)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+                self._dispatcher.start()
+            self._cond.notify_all()
+        return job
+
+    def pending(self):
+        with self._cond:
+            return {
+                provider: sum(len(jobs) for jobs in sessions.values())
+                for provider, sessions in self._queues.items()
+            }
+
+    def _next_job(self):
+        for provider, sessions in self._queues.items():
+            if not sessions or self._active[provider] >= self.concurrency.get(provider, self.default_concurrency):
+                continue
+            # Take the oldest waiting session's next job and send that session to the back of the line
+            session_id, jobs = sessions.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                sessions[session_id] = jobs
+            return job
+        return None
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._active[job.provider] += 1
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        try:
+            if not job.cancelled:
+                job.run()
+        finally:
+            with self._cond:
+                self._active[job.provider] -= 1
+                self._cond.notify_all()
+
+
+WORKER = InferenceWorker(
+    default_concurrency=int(os.getenv("PERSONAL_LLM_WORKER_CONCURRENCY", DEFAULT_CONCURRENCY)),
+    max_queue=int(os.getenv("PERSONAL_LLM_WORKER_QUEUE", 32)),
+)
+
+
+class EmbeddingBatcher:
+    def __init__(self, window=0.01):
+        """
+        Merges partial text-embedding batches for the same model that arrive within `window`
+        seconds from different callers (typically sessions ingesting at once) into as few
+        provider calls as possible. The first caller in a window waits it out and makes the
+        merged calls for everyone, concurrently up to the caller's worker count.
+        Full batches, and a caller's own concurrent batches, are never held back: they go
+        straight to the provider so a pipeline's parallelism is kept.
+        """
+        self.window = window
+        self._pending = {}  # id(embed_model) -> [(texts, future, caller)]
+        self._lock = threading.Lock()
+
+    def embed(self, embed_model, texts, max_batch=64, caller=None, max_workers=1):
+        if len(texts) >= max_batch:
+            return embed_model.get_text_embedding_batch(texts)
+
+        future = Future()
+        key = id(embed_model)
+        with self._lock:
+            group = self._pending.setdefault(key, [])
+            if caller is not None and any(pending_caller == caller for _, _, pending_caller in group):
+                group = None
+            else:
+                group.append((texts, future, caller))
+                leader = len(group) == 1
+        if group is None:
+            # Another batch of the same caller is already waiting: merging them would serialize it
+            return embed_model.get_text_embedding_batch(texts)
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                group = self._pending.pop(key)
+            self._flush(embed_model, group, max_batch, max_workers)
+        return future.result()
+
+    @staticmethod
+    def _flush(embed_model, group, max_batch, max_workers):
+        try:
+            texts = [text for request, _, _ in group for text in request]
+            slices = [texts[i:i + max_batch] for i in range(0, len(texts), max_batch)]
+            if len(slices) > 1 and max_workers > 1:
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(slices))) as pool:
+                    results = list(pool.map(embed_model.get_text_embedding_batch, slices))
+            else:
+                results = [embed_model.get_text_embedding_batch(batch) for batch in slices]
+            embeddings = [embedding for batch in results for embedding in batch]
+            if len(group) > 1:
+                logger.debug(f"Merged {len(group)} embedding requests into {len(texts)} texts.")
+            offset = 0
+            for request, future, _ in group:
+                future.set_result(embeddings[offset:offset + len(request)])
+                offset += len(request)
+        except Exception as e:
+            for _, future, _ in group:
+                if not future.done():
+                    future.set_exception(e)
+
+
+EMBED_BATCHER = EmbeddingBatcher(window=float(os.getenv("PERSONAL_LLM_EMBED_BATCH_WINDOW", 0.01)))
+
+
+class _QueuedResponse:
+    """
+    Streaming response whose tokens are produced by the inference worker.
+    """
+    def __init__(self, job):
+        self.response_gen = job.stream()
+
+
+class QueuedChatEngine:
+    def __init__(self, chat_engine, session_id, provider, worker=None):
+        """
+        Runs stream_chat (retrieval + generation) on the inference worker instead of the
+        calling Streamlit thread; tokens flow back through the job's queue.
+        """
+        self.chat_engine = chat_engine
+        self.session_id = session_id
+        self.provider = provider
+        self.worker = worker or WORKER
+
+    def stream_chat(self, message):
+        def generate():
+            yield from self.chat_engine.stream_chat(message).response_gen
+
+        return _QueuedResponse(self.worker.submit(self.session_id, self.provider, generate))
+
+    def __getattr__(self, name):
+        return getattr(self.chat_engine, name)
@@ -1,90 +1,407 @@
 import os
+import json
+import uuid
+import threading
+import urllib.request
+import weakref
+import hashlib
 import logging
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, Settings
-from llama_index.llms.ollama import Ollama
-from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.llms.gemini import Gemini
-from llama_index.embeddings.gemini import GeminiEmbedding
-from llama_index.llms.groq import Groq
+from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, StorageContext
+from llama_index.core.chat_engine import SimpleChatEngine
+from llama_index.core.llms import ChatMessage
+from embedding_pipeline import EmbeddingPipeline
+from chunking import ChunkingPipeline
+from client_registry import CLIENTS, key_fingerprint
+from index_store import IndexStore, document_hash
+from response_cache import CachedChatEngine
+from query_cache import MemoizedRetriever
+from conversation_memory import BudgetedContextChatEngine, RollingSummaryMemory
+from hybrid_retrieval import EmbeddingReranker, HybridRetriever
+from metrics import METRICS, InstrumentedChatEngine, TimedRetriever
+from inference_worker import QueuedChatEngine
+from provider_router import Route, RoutedLLM
+from vector_store import MmapVectorStore, SegmentStore
+from index_registry import INDEXES, IndexEntry, IndexLease, estimate_size
 
 # Configure Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Hybrid retrieval: candidates pulled from each retriever, and chunks kept after reranking
+HYBRID_CANDIDATE_TOP_K = int(os.getenv("PERSONAL_LLM_HYBRID_CANDIDATES", 10))
+RERANK_TOP_N = int(os.getenv("PERSONAL_LLM_RERANK_TOP_N", 3))
+# "mmap": embeddings in shared memory-mapped files (see MmapVectorStore); "memory": llama_index's in-RAM store
+VECTOR_STORE = os.getenv("PERSONAL_LLM_VECTOR_STORE", "mmap")
+VECTOR_DTYPE = os.getenv("PERSONAL_LLM_VECTOR_DTYPE", "float16")
+APPROXIMATE_SEARCH = os.getenv("PERSONAL_LLM_APPROXIMATE_SEARCH", "0") == "1"
+
+# Token budget for each turn's prompt: the retrieved context counts first, and the conversation
+# history (recent turns + running summary) gets the rest
+MEMORY_TOKEN_LIMIT = int(os.getenv("PERSONAL_LLM_MEMORY_TOKENS", 4000))
+
+def _build_clients(provider, model_name, api_key):
+    """
+    Instantiates the (llm, embed_model) pair for a provider.
+    Only called on a registry miss; see ClientRegistry.
+    Provider SDKs are imported here, so start-up only pays for the one actually used.
+    """
+    if provider == "gemini":
+        from llama_index.llms.gemini import Gemini
+        from llama_index.embeddings.gemini import GeminiEmbedding
+        if not api_key: raise ValueError("Gemini API Key missing.")
+        # Setup Gemini LLM (removed 'models/' prefix which causes 404s)
+        # We use 'gemini-1.5-flash-latest' or just 'gemini-pro' for maximum compatibility
+        llm = Gemini(model="gemini-1.5-flash", api_key=api_key)
+        
+        # Setup Gemini Embeddings
+        embed_model = GeminiEmbedding(model_name="embedding-001", api_key=api_key)
+    
+    elif provider == "groq":
+        from llama_index.llms.groq import Groq
+        from llama_index.embeddings.gemini import GeminiEmbedding
+        if not api_key: raise ValueError("Groq API Key missing.")
+        llm = Groq(model=model_name, api_key=api_key)
+        # Groq doesn't provide embeddings. We MUST use another provider.
+        # Detailed logic: You can't run Ollama on Cloud.
+        # So for Groq, we'll try to use Gemini Embeddings (requires Google Key!).
+        # But to keep it simple, we will assume user has Google Key in env for embeddings?
+        # Actually, worst case: No embeddings for Groq (Chat only).
+        # Let's use Gemini Embeddings as default Cloud fallback.
+        # NOTE: This implies users need a Google Key even for Groq RAG.
+        embed_model = GeminiEmbedding(model_name="models/embedding-001") # Tries to find env key
+
+    else: # Ollama
+        from llama_index.llms.ollama import Ollama
+        from llama_index.embeddings.ollama import OllamaEmbedding
+        llm = Ollama(model=model_name, request_timeout=360.0)
+        embed_model = OllamaEmbedding(model_name=model_name)
+
+    return llm, embed_model
+
+
+_warmed_up = set()
+_warm_up_lock = threading.Lock()
+
+
+def _preload_ollama(llm, embed_model):
+    # An /api/generate request without a prompt just loads the model into memory
+    request = urllib.request.Request(
+        f"{llm.base_url.rstrip('/')}/api/generate",
+        data=json.dumps({"model": llm.model, "keep_alive": "30m"}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=llm.request_timeout) as response:
+        response.read()
+    embed_model.get_text_embedding("warm-up")
+
+
+def warm_up(provider, model_name, api_key=None):
+    """
+    Builds the provider's clients in the background (importing its SDK) and, for Ollama,
+    loads the chat and embedding model, so the first real request doesn't pay for either.
+    Runs once per provider/model/key per process; safe to call on every Streamlit rerun.
+    """
+    key = (provider, model_name, key_fingerprint(api_key))
+    with _warm_up_lock:
+        if key in _warmed_up:
+            return
+        _warmed_up.add(key)
+
+    def run():
+        try:
+            llm, embed_model = CLIENTS.get_or_create(key, lambda: _build_clients(provider, model_name, api_key))
+            if provider == "ollama":
+                _preload_ollama(llm, embed_model)
+            logger.info(f"Warmed up {provider}/{model_name}.")
+        except Exception as e:
+            # Not fatal: the first request will just be slower (or report the real error)
+            logger.warning(f"Warm-up of {provider}/{model_name} failed: {e}")
+            with _warm_up_lock:
+                _warmed_up.discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _fingerprint(file_hashes):
+    """
+    Identifies a document set, independent of upload order.
+    """
+    if not file_hashes:
+        return "no-documents"
+    return hashlib.sha256("|".join(sorted(file_hashes)).encode("utf-8")).hexdigest()
+
+
+def _track_files(files, nodes):
+    # content hash -> ref_doc_ids of that file's nodes
+    for node in nodes:
+        files.setdefault(document_hash(node), set()).add(node.ref_doc_id)
+
+
 class LLMEngine:
-    def __init__(self, provider="ollama", model_name="llama3", api_key=None):
+    def __init__(self, provider="ollama", model_name="llama3", api_key=None, fallbacks=None, hedge_after=None):
         """
         Initialize the LLM Engine.
+        Clients come from the process-wide registry, so a new session with the same
+        provider/model/key reuses warm clients instead of building new ones.
+        The global llama_index Settings are never touched: llm and embed_model are
+        passed explicitly, so sessions using different providers don't interfere.
+        fallbacks is a list of (provider, model_name, api_key) that generation fails over to;
+        with hedge_after (seconds), the next provider is also started when the current one is slow
+        to produce a first token. Embeddings always come from the primary provider.
         """
         self.provider = provider
         self.model_name = model_name
+        # One engine per Streamlit session; the inference worker schedules fairly across these
+        self.session_id = uuid.uuid4().hex
         
         try:
-            if provider == "gemini":
-                if not api_key: raise ValueError("Gemini API Key missing.")
-                # Setup Gemini LLM (removed 'models/' prefix which causes 404s)
-                # We use 'gemini-1.5-flash-latest' or just 'gemini-pro' for maximum compatibility
-                self.llm = Gemini(model="gemini-1.5-flash", api_key=api_key)
-                
-                # Setup Gemini Embeddings
-                self.embed_model = GeminiEmbedding(model_name="embedding-001", api_key=api_key)
-            
-            elif provider == "groq":
-                if not api_key: raise ValueError("Groq API Key missing.")
-                self.llm = Groq(model=model_name, api_key=api_key)
-                # Groq doesn't provide embeddings. We MUST use another provider.
-                # Detailed logic: You can't run Ollama on Cloud.
-                # So for Groq, we'll try to use Gemini Embeddings (requires Google Key!).
-                # But to keep it simple, we will assume user has Google Key in env for embeddings?
-                # Actually, worst case: No embeddings for Groq (Chat only).
-                # Let's use Gemini Embeddings as default Cloud fallback.
-                # NOTE: This implies users need a Google Key even for Groq RAG.
-                self.embed_model = GeminiEmbedding(model_name="models/embedding-001") # Tries to find env key
-
-            else: # Ollama
-                self.llm = Ollama(model=model_name, request_timeout=360.0)
-                self.embed_model = OllamaEmbedding(model_name=model_name)
-
-            # Apply Settings
-            Settings.llm = self.llm
-            Settings.embed_model = self.embed_model
-            
+            key = (provider, model_name, key_fingerprint(api_key))
+            self.llm, self.embed_model = CLIENTS.get_or_create(
+                key, lambda: _build_clients(provider, model_name, api_key)
+            )
         except Exception as e:
             logger.error(f"Failed to initialize {provider}: {e}")
             raise e
 
+        if fallbacks:
+            routes = [Route(provider, model_name, self.llm)]
+            for fallback_provider, fallback_model, fallback_key in fallbacks:
+                try:
+                    key = (fallback_provider, fallback_model, key_fingerprint(fallback_key))
+                    llm, _ = CLIENTS.get_or_create(
+                        key, lambda: _build_clients(fallback_provider, fallback_model, fallback_key)
+                    )
+                    routes.append(Route(fallback_provider, fallback_model, llm))
+                except Exception as e:
+                    # A fallback that can't even be built is just left out
+                    logger.warning(f"Skipping fallback {fallback_provider}: {e}")
+            if len(routes) > 1:
+                self.llm = RoutedLLM(routes=routes, hedge_after=hedge_after)
+
         self.index = None
+        # One conversation per engine, shared by every chat engine it hands out,
+        # so switching from plain chat to RAG keeps the history.
+        # Older turns are summarized in the background to stay within the token budget.
+        self.memory = RollingSummaryMemory.from_llm(self.llm, token_limit=MEMORY_TOKEN_LIMIT)
+        # Content hash -> ref_doc_ids of that file's nodes in the index (read-only: shared with other sessions)
+        self.indexed_files = {}
+        # Identifies the indexed document set; scopes the semantic answer cache
+        self.index_fingerprint = "no-documents"
+        # Hold on the shared index; given back to the registry when this engine is collected
+        self._lease = IndexLease(INDEXES)
+        weakref.finalize(self, self._lease.release)
+        # Format-aware chunking sized for this provider's embedding model
+        self.chunker = ChunkingPipeline.for_provider(provider)
+        # Identifies the embedding model, e.g. for memoized query embeddings
+        self.embed_model_key = f"{provider}:{self.embed_model.model_name}"
+        # Embedded nodes are cached on disk per embedding model and chunking settings
+        self.index_store = IndexStore(f"{self.embed_model_key}:{self.chunker.config_key}")
+        # With the mmap store, vectors are written to their segment as files are embedded
+        self.segments = SegmentStore(self.index_store.model_dir, VECTOR_DTYPE) if VECTOR_STORE == "mmap" else None
+        # Batched, concurrent embedding with per-provider rate limiting
+        self.embedder = EmbeddingPipeline(self.embed_model, provider=provider)
 
     def create_index(self, input_files):
         """
-        Creates a VectorStoreIndex from a list of input files.
+        Creates a VectorStoreIndex from input Documents (a list, or the stream from FileHandler.iter_documents).
+        Files that were embedded before (same content, same embedding model) are loaded from disk.
+        Replaces whatever was indexed before; use add_documents/remove_documents to apply a delta.
         """
         try:
             if not input_files:
                 return "No files provided."
-            
-            logger.info(f"Processing {len(input_files)} files...")
-            self.index = VectorStoreIndex.from_documents(input_files)
+
+            self._attach(None)
+            self.add_documents(input_files)
             logger.info("Index created successfully.")
             return self.index
         except Exception as e:
             logger.error(f"Error creating index: {e}")
             raise e
 
-    def get_chat_engine(self):
+    def add_documents(self, documents):
         """
-        Returns a chat engine with memory.
+        Adds Documents to this engine's index.
+        Files that are already indexed (by content hash) are skipped, so only new files are
+        parsed into nodes, and only files never seen by this embedding model are embedded.
+        If another session already holds an index over the resulting document set, this engine
+        attaches to it instead of building its own.
+        Returns the content hashes of the files that were added.
         """
-        if not self.index:
-            # If no files, return detailed chat engine (just LLM + Memory)
-            # We need to create an empty index or just use the LLM directly with memory buffer.
-            # LlamaIndex makes it easiest to just have an index.
-            # Let's create an empty index if none exists.
-            self.index = VectorStoreIndex.from_documents([])
-        
-        # Use "context" mode: capable of using the index + conversation history
-        return self.index.as_chat_engine(
-            chat_mode="context", 
-            llm=self.llm,
-            verbose=True
+        new_documents = (doc for doc in documents if document_hash(doc) not in self.indexed_files)
+        nodes = self.index_store.build_nodes(
+            new_documents,
+            self.embedder,
+            node_parser=self.chunker,
+            segments=self.segments,
+            provider=self.provider,
+            model=self.model_name,
         )
+        if not nodes:
+            return []
+
+        added = list(dict.fromkeys(document_hash(node) for node in nodes))
+        self._update_index(set(self.indexed_files) | set(added), add_nodes=nodes)
+        return added
+
+    def remove_documents(self, file_hashes):
+        """
+        Removes the given files (by content hash) from this engine's index.
+        Unknown hashes are ignored. Returns the hashes that were removed.
+        """
+        removed = [file_hash for file_hash in dict.fromkeys(file_hashes) if file_hash in self.indexed_files]
+        if removed:
+            logger.info(f"Removing {len(removed)} files from the index.")
+            self._update_index(set(self.indexed_files) - set(removed), remove=removed)
+        return removed
+
+    def restore_documents(self, file_hashes):
+        """
+        Moves this engine to the index over exactly these files (by content hash), e.g. the ones
+        a saved conversation was bound to. Needs no uploads: nodes come from the on-disk cache,
+        or from a shared index over the same files. Returns the hashes that could not be restored
+        because they were never embedded with this engine's embedding model.
+        """
+        available = {h for h in file_hashes if h in self.indexed_files or self.index_store.has(h)}
+        remove = [h for h in self.indexed_files if h not in available]
+        add_nodes = [node for h in sorted(available - set(self.indexed_files)) for node in self.index_store.load_nodes(h, self.segments)]
+        if remove or add_nodes:
+            self._update_index(available, add_nodes=add_nodes, remove=remove)
+        return [h for h in file_hashes if h not in available]
+
+    def _index_key(self, file_hashes):
+        return (self.index_store.embed_model_key, VECTOR_STORE, VECTOR_DTYPE, _fingerprint(file_hashes))
+
+    def _update_index(self, file_hashes, add_nodes=(), remove=()):
+        """
+        Moves this engine to the index over file_hashes: attaches to a shared one if it exists,
+        otherwise updates the current index in place when no other session uses it, or builds a new one.
+        """
+        if not file_hashes:
+            self._attach(None)
+            return
+
+        key = self._index_key(file_hashes)
+        entry = INDEXES.acquire(key)
+        if entry is None:
+            current = self._lease.entry
+            with METRICS.span("index_build", provider=self.provider, model=self.model_name):
+                if current is not None and INDEXES.detach(current):
+                    # Sole user: apply the delta in place (copy-on-write only when shared)
+                    self._apply_delta(current, add_nodes, remove)
+                    current.key = key
+                    current.size_bytes = estimate_size(
+                        current.index.docstore.docs.values(), VECTOR_STORE != "mmap"
+                    )
+                    entry = INDEXES.add(current)
+                else:
+                    entry = INDEXES.add(self._build_entry(key, file_hashes, add_nodes))
+        self._attach(entry)
+
+    def _apply_delta(self, entry, add_nodes, remove):
+        for file_hash in remove:
+            for ref_doc_id in entry.files.pop(file_hash, ()):
+                entry.index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+        if add_nodes:
+            logger.info(f"Indexing {len(add_nodes)} chunks...")
+            entry.index.insert_nodes(add_nodes)
+            _track_files(entry.files, add_nodes)
+        entry._bm25 = None
+
+    def _build_entry(self, key, file_hashes, add_nodes):
+        # Nodes of files this engine already had are reloaded from the on-disk cache, not re-embedded
+        new_hashes = {document_hash(node) for node in add_nodes}
+        nodes = list(add_nodes)
+        for file_hash in sorted(file_hashes - new_hashes):
+            nodes.extend(self.index_store.load_nodes(file_hash, self.segments))
+        logger.info(f"Indexing {len(nodes)} chunks...")
+        size_bytes = estimate_size(nodes, VECTOR_STORE != "mmap")
+        index = VectorStoreIndex(nodes=nodes, embed_model=self.embed_model, storage_context=self._storage_context())
+        files = {}
+        _track_files(files, nodes)
+        return IndexEntry(key, index, files, size_bytes)
+
+    def _attach(self, entry):
+        self._lease.swap(entry)
+        self.index = entry.index if entry else None
+        self.indexed_files = entry.files if entry else {}
+        self.index_fingerprint = entry.key[-1] if entry else "no-documents"
+
+    def _storage_context(self):
+        if VECTOR_STORE != "mmap":
+            return StorageContext.from_defaults()
+        # Lives next to the cached nodes, so every session indexing a file maps the same vectors
+        vector_store = MmapVectorStore(
+            self.index_store.model_dir, dtype=VECTOR_DTYPE, approximate=APPROXIMATE_SEARCH
+        )
+        return StorageContext.from_defaults(vector_store=vector_store)
+
+    def reset_memory(self):
+        """
+        Starts a new conversation.
+        """
+        self.memory.reset()
+
+    def load_history(self, messages):
+        """
+        Continues a saved conversation: replaces the memory with the given messages
+        (dicts with role and content, oldest first).
+        """
+        self.memory.reset()
+        self.memory.set([ChatMessage(role=m["role"], content=m["content"]) for m in messages])
+
+    def get_chat_engine(self, use_cache=False, retrieval_mode="vector", top_k=None):
+        """
+        Returns a chat engine with memory.
+        Without indexed documents this is a plain LLM chat; once documents are indexed it
+        retrieves from them. Both share the engine's memory, so history carries over.
+        retrieval_mode "hybrid" fuses BM25 keyword search with the vector index and reranks
+        the candidates locally down to top_k chunks (default RERANK_TOP_N).
+        With use_cache, near-identical questions against the same documents are answered
+        from the process-wide semantic cache instead of the LLM.
+        """
+        memory = self.memory
+        tags = {"provider": self.provider, "model": self.model_name}
+        if not self.indexed_files:
+            # No documents: talk to the LLM directly, no retrieval step or context prompt
+            chat_engine = SimpleChatEngine.from_defaults(llm=self.llm, memory=memory)
+        else:
+            if retrieval_mode == "hybrid":
+                top_k = top_k or RERANK_TOP_N
+                retriever = HybridRetriever(
+                    self.index.as_retriever(similarity_top_k=HYBRID_CANDIDATE_TOP_K),
+                    self._lease.entry.bm25(),
+                    EmbeddingReranker(
+                        embed_model=self.embed_model, top_n=top_k, vector_store=self.index.vector_store
+                    ),
+                    candidate_top_k=HYBRID_CANDIDATE_TOP_K,
+                )
+            else:
+                retriever_kwargs = {"similarity_top_k": top_k} if top_k else {}
+                retriever = self.index.as_retriever(**retriever_kwargs)
+            # Repeated queries against this index reuse their embedding and results
+            retriever = MemoizedRetriever(
+                retriever, self.embed_model, self.embed_model_key, self._lease.entry, (retrieval_mode, top_k)
+            )
+            # "context" mode: retrieved chunks + conversation history, both within the memory's budget
+            chat_engine = BudgetedContextChatEngine.from_defaults(
+                retriever=TimedRetriever(retriever, mode=retrieval_mode, **tags),
+                llm=self.llm,
+                memory=memory,
+            )
+        # Generation runs on the shared inference worker, within the provider's concurrency limit
+        chat_engine = QueuedChatEngine(chat_engine, self.session_id, self.provider)
+        if use_cache:
+            # Answers depend on the generating model and the retrieval setup as well as the documents
+            fingerprint = f"{self.provider}:{self.model_name}:{retrieval_mode}:{top_k}:{self.index_fingerprint}"
+            chat_engine = CachedChatEngine(
+                chat_engine, memory, self.embed_model, fingerprint, embed_model_key=self.embed_model_key
+            )
+        return InstrumentedChatEngine(chat_engine, served_by=self._served_by, **tags)
+
+    def _served_by(self):
+        # After a failover the reply came from a fallback, not from self.provider
+        provider = getattr(self.llm, "last_provider", None)
+        if provider is None:
+            return {}
+        return {"provider": provider, "model": self.llm.last_model}
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llama_index.core.base.base_retriever import BaseRetriever
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets (seconds), from a cache hit up to a slow local generation
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Series:
+    def __init__(self, window):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.recent = deque(maxlen=window)  # for percentiles in the admin panel
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics:
+    def __init__(self, log_path=None, window=500):
+        """
+        Process-wide span timings for the ingest and chat hot paths.
+        Each span name + tag set is kept as a histogram, exported in Prometheus text format;
+        with log_path set, every span is also appended to a JSONL file.
+        """
+        self.log_path = log_path
+        self.window = window
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, **tags):
+        """
+        Records a span that was timed elsewhere (e.g. in a worker process).
+        """
+        key = (name, tuple(sorted((k, str(v)) for k, v in tags.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(self.window)
+            series.add(seconds)
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"ts": time.time(), "span": name, "seconds": seconds, **tags}) + "\n")
+
+    @contextmanager
+    def span(self, name, **tags):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **tags)
+
+    def summary(self):
+        """
+        One row per series with count, mean, p50 and p95 (over the recent window), for display.
+        """
+        rows = []
+        with self._lock:
+            for (name, tags), series in sorted(self._series.items()):
+                recent = sorted(series.recent)
+                rows.append({
+                    "span": name,
+                    **dict(tags),
+                    "count": series.count,
+                    "mean_ms": 1000 * series.total / series.count,
+                    "p50_ms": 1000 * recent[int(0.50 * (len(recent) - 1))],
+                    "p95_ms": 1000 * recent[int(0.95 * (len(recent) - 1))],
+                })
+        return rows
+
+    def render_prometheus(self):
+        lines = [
+            "# HELP personal_llm_span_seconds Duration of instrumented spans.",
+            "# TYPE personal_llm_span_seconds histogram",
+        ]
+        with self._lock:
+            for (name, tags), series in sorted(self._series.items()):
+                labels = [("span", name), *tags]
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                for bound, count in zip(BUCKETS, series.buckets):
+                    lines.append(f'personal_llm_span_seconds_bucket{{{label_text},le="{bound}"}} {count}')
+                lines.append(f'personal_llm_span_seconds_bucket{{{label_text},le="+Inf"}} {series.count}')
+                lines.append(f"personal_llm_span_seconds_sum{{{label_text}}} {series.total}")
+                lines.append(f"personal_llm_span_seconds_count{{{label_text}}} {series.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = Metrics(log_path=os.getenv("PERSONAL_LLM_METRICS_LOG"))
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """
+    Serves METRICS in Prometheus text format on http://host:port/metrics.
+    Safe to call on every Streamlit rerun; only the first call starts the server.
+    """
+    global _server
+    with _server_lock:
+        if _server is not None:
+            return _server
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = METRICS.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        _server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+        logger.info(f"Metrics served on http://{host}:{port}/metrics")
+        return _server
+
+
+class TimedRetriever(BaseRetriever):
+    def __init__(self, retriever, **tags):
+        """
+        Wraps a retriever and records each retrieval as a "retrieve" span.
+        """
+        super().__init__()
+        self.retriever = retriever
+        self.tags = tags
+
+    def _retrieve(self, query_bundle):
+        with METRICS.span("retrieve", **self.tags):
+            return self.retriever.retrieve(query_bundle)
+
+
+class _TimedResponse:
+    """
+    Wraps a streaming response; records time to first token and full generation as it is consumed.
+    """
+    def __init__(self, response, start, tags, served_by=None):
+        self._response = response
+        self._start = start
+        self._tags = tags
+        self._served_by = served_by
+        self.response_gen = self._stream()
+
+    def _stream(self):
+        tags = self._tags
+        first = True
+        for part in self._response.response_gen:
+            if first:
+                # By the first token a routed LLM has settled on the provider that answers
+                if self._served_by:
+                    tags = {**tags, **self._served_by()}
+                METRICS.observe("first_token", time.perf_counter() - self._start, **tags)
+                first = False
+            yield part
+        METRICS.observe("generation", time.perf_counter() - self._start, **tags)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class InstrumentedChatEngine:
+    def __init__(self, chat_engine, served_by=None, **tags):
+        """
+        Times stream_chat: first token and full generation, measured from the call
+        (so retrieval and prompt building are included).
+        served_by, if given, returns the tags (provider, model) of whoever actually answered,
+        e.g. a fallback provider; they replace the matching tags of that turn's spans.
+        """
+        self.chat_engine = chat_engine
+        self.served_by = served_by
+        self.tags = tags
+
+    def stream_chat(self, message):
+        start = time.perf_counter()
+        response = self.chat_engine.stream_chat(message)
+        return _TimedResponse(response, start, self.tags, self.served_by)
+
+    def __getattr__(self, name):
+        return getattr(self.chat_engine, name)
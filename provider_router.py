@@ -0,0 +1,283 @@
+import os
+import time
+import queue
+import logging
+import threading
+from typing import Any, List, Optional
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms import LLM
+
+logger = logging.getLogger(__name__)
+
+# Without hedging: how long to wait for a first token before giving up on a provider
+FIRST_TOKEN_TIMEOUT = float(os.getenv("PERSONAL_LLM_FIRST_TOKEN_TIMEOUT", 60))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        """
+        Health of one provider, shared by every session in the process.
+        After failure_threshold consecutive failures the circuit opens and the provider is
+        skipped for reset_timeout seconds; after that it is tried again (half-open), and a
+        single further failure opens it again. Also keeps a moving average of time to first token.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.first_token_ewma = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def record_success(self, first_token_seconds=None):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            if first_token_seconds is not None:
+                previous = self.first_token_ewma
+                self.first_token_ewma = first_token_seconds if previous is None else 0.8 * previous + 0.2 * first_token_seconds
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+    def status(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "first_token_ms": None if self.first_token_ewma is None else 1000 * self.first_token_ewma,
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider):
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(
+                failure_threshold=int(os.getenv("PERSONAL_LLM_BREAKER_FAILURES", 3)),
+                reset_timeout=float(os.getenv("PERSONAL_LLM_BREAKER_RESET", 30)),
+            )
+        return _breakers[provider]
+
+
+def provider_health():
+    """
+    Circuit state and first-token latency per provider, for display.
+    """
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return [{"provider": provider, **breaker.status()} for provider, breaker in sorted(breakers.items())]
+
+
+class Route:
+    def __init__(self, provider, model_name, llm):
+        self.provider = provider
+        self.model_name = model_name
+        self.llm = llm
+        self.breaker = get_breaker(provider)
+
+
+class _Attempt:
+    """
+    One provider streaming a response on its own thread into the shared queue.
+    """
+    def __init__(self, route, start_stream, results):
+        self.route = route
+        self.cancelled = False
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        threading.Thread(target=self._run, args=(start_stream, results), daemon=True).start()
+
+    def _run(self, start_stream, results):
+        try:
+            for item in start_stream(self.route.llm):
+                if self.cancelled:
+                    return
+                if self.first_token_at is None:
+                    self.first_token_at = time.perf_counter() - self.started
+                results.put((self, "item", item))
+            self.route.breaker.record_success(self.first_token_at)
+            results.put((self, "done", None))
+        except Exception as e:
+            if not self.cancelled:
+                self.route.breaker.record_failure()
+            results.put((self, "error", e))
+
+
+class RoutedLLM(LLM):
+    """
+    LLM that routes each request over several providers in preference order.
+    Providers whose circuit is open are skipped; an error or a first-token timeout fails
+    over to the next one. With hedge_after set, a second provider is started when the
+    first hasn't produced a token within that many seconds, and whichever answers first wins.
+    Failover only happens before the first token; after that the stream belongs to one provider.
+    """
+    routes: List[Any] = Field(description="Route objects, most preferred first.")
+    hedge_after: Optional[float] = Field(default=None, description="Seconds before firing a hedged request.")
+    first_token_timeout: float = Field(default=FIRST_TOKEN_TIMEOUT)
+
+    _last_route: Any = PrivateAttr(default=None)
+
+    @classmethod
+    def class_name(cls):
+        return "RoutedLLM"
+
+    @property
+    def metadata(self):
+        return self.routes[0].llm.metadata
+
+    @property
+    def last_provider(self):
+        """
+        Provider that served the most recent request.
+        """
+        return self._last_route.provider if self._last_route else None
+
+    @property
+    def last_model(self):
+        return self._last_route.model_name if self._last_route else None
+
+    def _candidates(self):
+        healthy = [route for route in self.routes if route.breaker.state != "open"]
+        # Everything tripped: still try, in order, rather than fail without asking anyone
+        return healthy or list(self.routes)
+
+    def _call(self, method, *args, **kwargs):
+        last_error = None
+        for route in self._candidates():
+            try:
+                result = getattr(route.llm, method)(*args, **kwargs)
+                route.breaker.record_success()
+                self._last_route = route
+                return result
+            except Exception as e:
+                route.breaker.record_failure()
+                logger.warning(f"{route.provider} failed ({e}), failing over.")
+                last_error = e
+        raise last_error
+
+    async def _acall(self, method, *args, **kwargs):
+        last_error = None
+        for route in self._candidates():
+            try:
+                result = await getattr(route.llm, method)(*args, **kwargs)
+                route.breaker.record_success()
+                self._last_route = route
+                return result
+            except Exception as e:
+                route.breaker.record_failure()
+                logger.warning(f"{route.provider} failed ({e}), failing over.")
+                last_error = e
+        raise last_error
+
+    def _stream(self, start_stream):
+        candidates = self._candidates()
+        results = queue.Queue()
+        active = []
+        last_error = None
+
+        def start_next():
+            route = candidates.pop(0)
+            active.append(_Attempt(route, start_stream, results))
+
+        start_next()
+        winner = None
+        while winner is None:
+            hedging = self.hedge_after is not None and candidates and len(active) == 1
+            timeout = self.hedge_after if hedging else self.first_token_timeout
+            try:
+                attempt, kind, payload = results.get(timeout=timeout)
+            except queue.Empty:
+                if not candidates:
+                    for slow in active:
+                        slow.cancelled = True
+                        slow.route.breaker.record_failure()
+                    last_error = TimeoutError(f"No provider answered within {self.first_token_timeout:.0f}s.")
+                    break
+                if not hedging:
+                    # Too slow: give up on everything still waiting and move on
+                    for slow in active:
+                        slow.cancelled = True
+                        slow.route.breaker.record_failure()
+                        logger.warning(f"{slow.route.provider} produced no token in {timeout:.1f}s, failing over.")
+                    active.clear()
+                else:
+                    logger.info(f"{active[0].route.provider} slow to first token, hedging with {candidates[0].provider}.")
+                start_next()
+                continue
+
+            if attempt not in active:
+                continue  # leftovers from a cancelled attempt
+            if kind == "item":
+                winner = attempt
+                first = payload
+            elif kind == "error":
+                logger.warning(f"{attempt.route.provider} failed ({payload}), failing over.")
+                last_error = payload
+                active.remove(attempt)
+                if not active:
+                    if not candidates:
+                        break
+                    start_next()
+            else:
+                # Finished without producing anything: an empty answer still counts as an answer
+                winner = attempt
+                first = None
+
+        if winner is None:
+            raise last_error
+
+        for other in active:
+            if other is not winner:
+                other.cancelled = True
+        self._last_route = winner.route
+
+        if first is None:
+            return
+        yield first
+        while True:
+            attempt, kind, payload = results.get()
+            if attempt is not winner:
+                continue
+            if kind == "item":
+                yield payload
+            elif kind == "error":
+                raise payload
+            else:
+                return
+
+    def chat(self, messages, **kwargs):
+        return self._call("chat", messages, **kwargs)
+
+    def complete(self, prompt, formatted=False, **kwargs):
+        return self._call("complete", prompt, formatted=formatted, **kwargs)
+
+    def stream_chat(self, messages, **kwargs):
+        return self._stream(lambda llm: llm.stream_chat(messages, **kwargs))
+
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        return self._stream(lambda llm: llm.stream_complete(prompt, formatted=formatted, **kwargs))
+
+    async def achat(self, messages, **kwargs):
+        return await self._acall("achat", messages, **kwargs)
+
+    async def acomplete(self, prompt, formatted=False, **kwargs):
+        return await self._acall("acomplete", prompt, formatted=formatted, **kwargs)
+
+    async def astream_chat(self, messages, **kwargs):
+        return await self._acall("astream_chat", messages, **kwargs)
+
+    async def astream_complete(self, prompt, formatted=False, **kwargs):
+        return await self._acall("astream_complete", prompt, formatted=formatted, **kwargs)
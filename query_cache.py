@@ -0,0 +1,111 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(text):
+    """
+    Memo key for a query: case and whitespace differences don't change what is retrieved.
+    """
+    return " ".join(text.casefold().split())
+
+
+class _LRU:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        # Computed outside the lock: a slow embedding call must not block other sessions
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class QueryCache:
+    def __init__(self, max_embeddings=1024, max_results=256):
+        """
+        Process-wide LRU memo of query embeddings, keyed by embedding model and normalized
+        query text, and of retrieval results, keyed by index, retriever settings and query.
+        Index keys change whenever the indexed document set does (see LLMEngine._index_key),
+        so results from an older index are never served; they just age out.
+        """
+        self.embeddings = _LRU(max_embeddings)
+        self.results = _LRU(max_results)
+
+    def embedding(self, embed_model_key, query, compute):
+        return self.embeddings.get_or_compute((embed_model_key, normalize_query(query)), compute)
+
+    def retrieve(self, scope, query, compute):
+        return self.results.get_or_compute((scope, normalize_query(query)), compute)
+
+    def stats(self):
+        return {
+            "embedding_hits": self.embeddings.hits,
+            "embedding_misses": self.embeddings.misses,
+            "result_hits": self.results.hits,
+            "result_misses": self.results.misses,
+        }
+
+    def clear(self):
+        self.embeddings.clear()
+        self.results.clear()
+
+
+QUERY_CACHE = QueryCache(
+    max_embeddings=int(os.getenv("PERSONAL_LLM_QUERY_CACHE_SIZE", 1024)),
+    max_results=int(os.getenv("PERSONAL_LLM_QUERY_CACHE_SIZE", 1024)) // 4,
+)
+
+
+class MemoizedRetriever(BaseRetriever):
+    def __init__(self, retriever, embed_model, embed_model_key, entry, settings, cache=None):
+        """
+        Wraps a retriever so a repeated query against an unchanged index skips both the
+        query embedding and the search. entry is the IndexEntry being searched; its key is read
+        on every call, since an index updated in place gets a new key. settings identifies the
+        retriever configuration (mode, top_k).
+        """
+        super().__init__()
+        self.retriever = retriever
+        self.embed_model = embed_model
+        self.embed_model_key = embed_model_key
+        self.entry = entry
+        self.settings = settings
+        self.cache = cache or QUERY_CACHE
+
+    def _retrieve(self, query_bundle):
+        def search():
+            if query_bundle.embedding is None:
+                # The vector retriever (and the reranker) use this instead of embedding again
+                query_bundle.embedding = self.cache.embedding(
+                    self.embed_model_key,
+                    query_bundle.query_str,
+                    lambda: self.embed_model.get_query_embedding(query_bundle.query_str),
+                )
+            return self.retriever.retrieve(query_bundle)
+
+        results = self.cache.retrieve((self.entry.key, self.settings), query_bundle.query_str, search)
+        # Fresh wrappers, so nothing downstream can change the cached scores
+        return [NodeWithScore(node=n.node, score=n.score) for n in results]
@@ -0,0 +1,161 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from llama_index.core.llms import ChatMessage, MessageRole
+from query_cache import QUERY_CACHE
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    def __init__(self, similarity_threshold=0.95, ttl_seconds=3600, max_entries=512):
+        """
+        Process-wide cache of finished answers, looked up by query-embedding similarity.
+        Entries are scoped by a fingerprint (model + indexed documents), expire after
+        ttl_seconds and are evicted least-recently-used beyond max_entries.
+        """
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # id -> (fingerprint, unit vector, answer, created_at)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, fingerprint, query_embedding):
+        """
+        Returns the cached answer for the most similar earlier query, or None.
+        """
+        query = self._normalize(query_embedding)
+        now = time.time()
+        with self._lock:
+            expired = [k for k, e in self._entries.items() if now - e[3] > self.ttl_seconds]
+            for k in expired:
+                del self._entries[k]
+
+            candidates = [
+                (k, e) for k, e in self._entries.items()
+                if e[0] == fingerprint and e[1].shape == query.shape
+            ]
+            if candidates:
+                scores = np.stack([e[1] for _, e in candidates]) @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    key, entry = candidates[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+
+            self.misses += 1
+            return None
+
+    def store(self, fingerprint, query_embedding, answer):
+        if not answer:
+            return
+        with self._lock:
+            self._entries[self._next_id] = (fingerprint, self._normalize(query_embedding), answer, time.time())
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+RESPONSE_CACHE = SemanticCache(
+    similarity_threshold=float(os.getenv("PERSONAL_LLM_CACHE_SIMILARITY", 0.95)),
+    ttl_seconds=int(os.getenv("PERSONAL_LLM_CACHE_TTL", 3600)),
+    max_entries=int(os.getenv("PERSONAL_LLM_CACHE_SIZE", 512)),
+)
+
+
+class CachedResponse:
+    """
+    Stand-in for StreamingAgentChatResponse on a cache hit: the stored answer in one piece.
+    """
+    def __init__(self, answer):
+        self.response = answer
+        self.response_gen = iter([answer])
+
+
+class _StoringResponse:
+    """
+    Wraps a live streaming response and stores the full answer once the stream ends.
+    """
+    def __init__(self, response, on_complete):
+        self._response = response
+        self._on_complete = on_complete
+        self.response_gen = self._stream()
+
+    def _stream(self):
+        parts = []
+        for part in self._response.response_gen:
+            parts.append(part)
+            yield part
+        self._on_complete("".join(parts))
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class CachedChatEngine:
+    def __init__(self, chat_engine, memory, embed_model, fingerprint, cache=None, embed_model_key=None):
+        """
+        Puts a SemanticCache in front of a chat engine's stream_chat.
+        On a hit the stored answer is returned without retrieval or an LLM call,
+        and the turn is still written to the conversation memory.
+        Only a conversation's first turn is cached: later turns depend on the history
+        ("explain that further"), which belongs to one conversation and one user.
+        With embed_model_key, the query embedding goes through QUERY_CACHE, so a miss
+        doesn't embed the same query again for retrieval.
+        """
+        self.chat_engine = chat_engine
+        self.memory = memory
+        self.embed_model = embed_model
+        self.fingerprint = fingerprint
+        self.cache = cache or RESPONSE_CACHE
+        self.embed_model_key = embed_model_key
+
+    def stream_chat(self, message):
+        if self.memory.get_all():
+            return self.chat_engine.stream_chat(message)
+        if self.embed_model_key:
+            query_embedding = QUERY_CACHE.embedding(
+                self.embed_model_key, message, lambda: self.embed_model.get_query_embedding(message)
+            )
+        else:
+            query_embedding = self.embed_model.get_query_embedding(message)
+        answer = self.cache.lookup(self.fingerprint, query_embedding)
+        if answer is not None:
+            logger.info("Semantic cache hit.")
+            self.memory.put(ChatMessage(role=MessageRole.USER, content=message))
+            self.memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+            return CachedResponse(answer)
+
+        response = self.chat_engine.stream_chat(message)
+        return _StoringResponse(
+            response, lambda text: self.cache.store(self.fingerprint, query_embedding, text)
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.chat_engine, name)
@@ -3,6 +3,28 @@ import sys
 from pyngrok import ngrok
 import subprocess
 import time
+import urllib.request
+
+PORT = 8501
+STARTUP_TIMEOUT = 60
+
+
+def wait_until_ready(process, timeout=STARTUP_TIMEOUT):
+    """
+    Polls Streamlit's health endpoint until the server answers, instead of sleeping a fixed time.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with urllib.request.urlopen(f"http://localhost:{PORT}/_stcore/health", timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
 
 def run_with_tunnel():
     print("==========================================")
@@ -16,19 +38,22 @@ def run_with_tunnel():
     # Start Streamlit in the background
     print("\n[1/2] Starting Streamlit App...")
     streamlit_process = subprocess.Popen(
-        [sys.executable, "-m", "streamlit", "run", "app.py", "--server.headless", "true"],
+        [sys.executable, "-m", "streamlit", "run", "app.py", "--server.headless", "true", "--server.port", str(PORT)],
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL
     )
     
-    # Give it a second to start
-    time.sleep(3)
+    # Wait until it actually serves requests
+    if not wait_until_ready(streamlit_process):
+        print("\n❌ Streamlit did not start. Run 'streamlit run app.py' to see the error.")
+        streamlit_process.terminate()
+        return
     
     # Open Tunnel
     print("[2/2] Opening Public Tunnel (ngrok)...")
     try:
         # Open a HTTP tunnel on the default port 8501
-        public_url = ngrok.connect(8501).public_url
+        public_url = ngrok.connect(PORT).public_url
         print(f"\n✅ YOUR PUBLIC URL: {public_url}")
         print(f"👉 Copy this link to your MOBILE phone to chat anywhere!")
         print("\n(Press Ctrl+C to stop)")
@@ -0,0 +1,43 @@
+import os
+import time
+
+# Minimum time between re-renders of a streaming answer
+RENDER_INTERVAL = float(os.getenv("PERSONAL_LLM_RENDER_INTERVAL", 0.05))
+
+
+class StreamRenderer:
+    def __init__(self, placeholder, interval=RENDER_INTERVAL, max_pending_chars=2000, cursor="▌"):
+        """
+        Renders a token stream into a Streamlit placeholder.
+        Tokens are collected in a list and the placeholder is redrawn at most once per
+        interval (or once max_pending_chars have piled up), instead of once per token.
+        """
+        self.placeholder = placeholder
+        self.interval = interval
+        self.max_pending_chars = max_pending_chars
+        self.cursor = cursor
+        self.parts = []
+        self.pending_chars = 0
+        self.last_render = 0.0
+
+    def write(self, part):
+        self.parts.append(part)
+        self.pending_chars += len(part)
+        now = time.monotonic()
+        if now - self.last_render >= self.interval or self.pending_chars >= self.max_pending_chars:
+            self._render(self.cursor)
+            self.last_render = now
+
+    def _render(self, suffix=""):
+        self.placeholder.markdown("".join(self.parts) + suffix)
+        self.pending_chars = 0
+
+    def text(self):
+        return "".join(self.parts)
+
+    def finish(self):
+        """
+        Draws the final answer without the cursor and returns it.
+        """
+        self._render()
+        return self.text()
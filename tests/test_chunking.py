@@ -0,0 +1,35 @@
+import io
+
+import pytest
+
+pytest.importorskip("llama_index.core")
+pytest.importorskip("numpy")
+
+import index_store
+from chunking import ChunkingPipeline
+from file_handler import FileHandler
+
+
+class FakeUpload(io.BytesIO):
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+
+def make_upload(name, words=400):
+    text = "\n\n".join(f"Section {name} {i}\n\n" + f"{name} word{i} " * 40 for i in range(words // 40))
+    return FakeUpload(name, text.encode("utf-8"))
+
+
+def test_chunks_keep_document_metadata():
+    upload = make_upload("notes.txt")
+    documents = list(FileHandler.iter_documents([upload]))
+    nodes = ChunkingPipeline(chunk_size=64).get_nodes_from_documents(documents)
+
+    assert len(nodes) > 1
+    file_hash = FileHandler.content_hash(upload.getvalue())
+    for node in nodes:
+        assert node.metadata["file_hash"] == file_hash
+        assert node.metadata["file_name"] == "notes.txt"
+        assert index_store.document_hash(node) == file_hash
@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip("llama_index.core")
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.llms import ChatMessage, MockLLM
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from conversation_memory import BudgetedContextChatEngine, RollingSummaryMemory
+
+
+class FixedRetriever(BaseRetriever):
+    def __init__(self, results):
+        super().__init__()
+        self.results = results
+
+    def _retrieve(self, query_bundle):
+        return self.results
+
+
+def make_engine(context_words, token_limit=400):
+    memory = RollingSummaryMemory(token_limit=token_limit)
+    memory.set([
+        ChatMessage(role=role, content=f"turn {i} " + "words " * 20)
+        for i, role in enumerate(["user", "assistant"] * 5)
+    ])
+    node = TextNode(text="context " * context_words)
+    engine = BudgetedContextChatEngine.from_defaults(
+        retriever=FixedRetriever([NodeWithScore(node=node, score=1.0)]), llm=MockLLM(), memory=memory
+    )
+    return engine, memory
+
+
+def test_retrieved_context_counts_against_the_budget():
+    engine, memory = make_engine(context_words=10)
+    engine.stream_chat("question").response_gen
+    small_context = memory.last_prompt_tokens
+
+    engine, memory = make_engine(context_words=300)
+    engine.stream_chat("question").response_gen
+    large_context = memory.last_prompt_tokens
+
+    # Reported tokens include the context, and the history shrinks to keep the total in budget
+    assert large_context > 300
+    assert small_context <= 400 and large_context <= 400
+    assert large_context - small_context < 290
+
+
+def test_history_fills_what_the_context_leaves():
+    engine, memory = make_engine(context_words=150)
+    context = engine._prompt_tokens("question", engine._get_nodes("question"))
+    history = memory.get(initial_token_count=context)
+
+    assert memory.last_prompt_tokens == context + memory._count(history)
+    assert memory.last_prompt_tokens <= memory.token_limit
+    assert len(history) < len(memory.get_all())
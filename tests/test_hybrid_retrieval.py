@@ -0,0 +1,59 @@
+import pytest
+
+pytest.importorskip("llama_index.core")
+pytest.importorskip("numpy")
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from hybrid_retrieval import BM25Index, EmbeddingReranker, HybridRetriever
+
+QUERY = "What is the status of ticket XJ-4471?"
+
+
+class FixedRetriever(BaseRetriever):
+    def __init__(self, results):
+        super().__init__()
+        self.results = results
+
+    def _retrieve(self, query_bundle):
+        return self.results
+
+
+def make_nodes():
+    # The dense side likes the generic notes; only the target mentions the ticket id
+    nodes = [
+        TextNode(id_=f"note{i}", text=f"Weekly update {i}: our queue keeps moving along.", embedding=[1.0, 0.1 * i])
+        for i in range(8)
+    ]
+    target = TextNode(id_="target", text="XJ-4471 was closed after the vendor shipped the patch.", embedding=[0.0, 1.0])
+    return nodes, target
+
+
+def test_keyword_hit_survives_reranking():
+    nodes, target = make_nodes()
+    dense = [NodeWithScore(node=node, score=0.9 - 0.01 * i) for i, node in enumerate(nodes)]
+    retriever = HybridRetriever(
+        FixedRetriever(dense),
+        BM25Index(nodes + [target]),
+        EmbeddingReranker(embed_model=MockEmbedding(embed_dim=2), top_n=3),
+    )
+
+    results = retriever.retrieve(QueryBundle(QUERY, embedding=[1.0, 0.0]))
+
+    assert len(results) == 3
+    assert "target" in [n.node.node_id for n in results]
+
+
+def test_reranker_keeps_fused_order_on_ties():
+    nodes, _ = make_nodes()
+    candidates = [
+        NodeWithScore(node=TextNode(id_=n.node_id, text="same", embedding=[1.0, 0.0]), score=1.0 / (i + 1))
+        for i, n in enumerate(nodes)
+    ]
+    reranker = EmbeddingReranker(embed_model=MockEmbedding(embed_dim=2), top_n=4)
+
+    results = reranker.postprocess_nodes(candidates, query_bundle=QueryBundle("same", embedding=[1.0, 0.0]))
+
+    assert [n.node.node_id for n in results] == ["note0", "note1", "note2", "note3"]
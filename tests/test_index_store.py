@@ -0,0 +1,76 @@
+import os
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("llama_index.core")
+pytest.importorskip("numpy")
+
+from llama_index.core import Document
+
+from index_store import IndexStore
+from vector_store import SegmentStore, segment_path
+
+FILE_HASH = "a" * 64
+
+
+class SlowEmbedder:
+    def __init__(self):
+        self.calls = 0
+
+    def embed(self, texts):
+        self.calls += 1
+        time.sleep(0.05)
+        return [[float(len(text) % 7) + 1.0, 1.0, float(i % 3)] for i, text in enumerate(texts)]
+
+
+def make_documents():
+    text = "\n\n".join(f"Paragraph {i}. " + "some words here " * 30 for i in range(20))
+    return [Document(text=text, metadata={"file_hash": FILE_HASH, "file_name": "notes.txt"})]
+
+
+@pytest.fixture
+def stores(tmp_path):
+    store = IndexStore("test:embed", persist_dir=str(tmp_path))
+    return store, SegmentStore(store.model_dir, "float16")
+
+
+def test_concurrent_builds_embed_a_file_once(stores):
+    store, segments = stores
+    embedder = SlowEmbedder()
+    results = [None, None]
+
+    def build(slot):
+        results[slot] = store.build_nodes(make_documents(), embedder, segments=segments)
+
+    threads = [threading.Thread(target=build, args=(slot,)) for slot in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    first, second = ([node.node_id for node in nodes] for nodes in results)
+    assert first and first == second
+    assert embedder.calls == 1
+    assert segments.stored_ids(FILE_HASH) == [node.node_id for node in store.iter_nodes(FILE_HASH)]
+    assert not [path for name in os.listdir(store.model_dir) if name.endswith(".tmp")]
+
+
+def test_mismatched_segment_is_rewritten(stores):
+    store, segments = stores
+    store.build_nodes(make_documents(), SlowEmbedder(), segments=segments)
+
+    # A segment committed by another build than the cached nodes
+    ids_path = segment_path(segments.persist_dir, segments.dtype, FILE_HASH, "ids.json")
+    with open(ids_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    meta["ids"] = [f"stale-{i}" for i in range(len(meta["ids"]))]
+    with open(ids_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    nodes = store.load_nodes(FILE_HASH, segments)
+
+    assert [node.node_id for node in nodes] == segments.stored_ids(FILE_HASH)
+    assert all(node.embedding == [] for node in nodes)
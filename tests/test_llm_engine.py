@@ -0,0 +1,64 @@
+import io
+
+import pytest
+
+pytest.importorskip("llama_index.core")
+pytest.importorskip("numpy")
+
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+
+import index_store
+from client_registry import CLIENTS, key_fingerprint
+from file_handler import FileHandler
+from index_registry import INDEXES
+from llm_engine import LLMEngine
+
+MODEL_NAME = "test"
+
+
+class FakeUpload(io.BytesIO):
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+
+def make_upload(name, words=400):
+    text = "\n\n".join(f"Section {name} {i}\n\n" + f"{name} word{i} " * 40 for i in range(words // 40))
+    return FakeUpload(name, text.encode("utf-8"))
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_store, "DEFAULT_INDEX_DIR", str(tmp_path))
+    INDEXES.clear()
+    CLIENTS.clear()
+    CLIENTS.get_or_create(
+        ("ollama", MODEL_NAME, key_fingerprint(None)),
+        lambda: (MockLLM(), MockEmbedding(embed_dim=8, model_name="mock-embed")),
+    )
+    yield LLMEngine(provider="ollama", model_name=MODEL_NAME)
+    INDEXES.clear()
+    CLIENTS.clear()
+
+
+def test_add_remove_restore_by_file_hash(engine):
+    first, second = make_upload("a.txt"), make_upload("b.txt")
+    hash_a = FileHandler.content_hash(first.getvalue())
+    hash_b = FileHandler.content_hash(second.getvalue())
+
+    added = engine.add_documents(FileHandler.iter_documents([first, second]))
+    assert sorted(added) == sorted([hash_a, hash_b])
+    assert set(engine.indexed_files) == {hash_a, hash_b}
+
+    # Same files again: nothing new to add
+    assert engine.add_documents(FileHandler.iter_documents([first, second])) == []
+
+    assert engine.remove_documents([hash_a]) == [hash_a]
+    assert set(engine.indexed_files) == {hash_b}
+
+    # A fresh session restores both files from the on-disk cache, without the uploads
+    restored = LLMEngine(provider="ollama", model_name=MODEL_NAME)
+    assert restored.restore_documents([hash_a, hash_b]) == []
+    assert set(restored.indexed_files) == {hash_a, hash_b}
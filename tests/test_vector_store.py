@@ -0,0 +1,112 @@
+import pytest
+
+pytest.importorskip("llama_index.core")
+np = pytest.importorskip("numpy")
+
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+import vector_store
+from vector_store import MmapVectorStore
+
+DIM = 32
+
+
+def make_nodes(count, file_hash="f" * 64, seed=0, dim=DIM):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(count, dim)).astype(np.float32)
+    nodes = []
+    for i, vector in enumerate(vectors):
+        node = TextNode(id_=f"{file_hash[:4]}-{i}", text=f"node {i}", embedding=vector.tolist())
+        node.metadata["file_hash"] = file_hash
+        # Two "documents" per file, so deleting one leaves the other visible
+        node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=f"{file_hash[:4]}-doc{i % 2}")
+        nodes.append(node)
+    return nodes, vectors
+
+
+def query(store, vector, top_k=5):
+    return store.query(VectorStoreQuery(query_embedding=list(map(float, vector)), similarity_top_k=top_k))
+
+
+def exact_top(vectors, query_vector, top_k):
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return list(np.argsort(-(unit @ (query_vector / np.linalg.norm(query_vector))))[:top_k])
+
+
+@pytest.fixture(autouse=True)
+def fresh_segments():
+    vector_store._segments.clear()
+    yield
+    vector_store._segments.clear()
+
+
+@pytest.mark.parametrize("dtype,tolerance", [("float32", 1e-6), ("float16", 2e-3), ("int8", 2e-2)])
+def test_quantized_search_round_trip(tmp_path, dtype, tolerance):
+    nodes, vectors = make_nodes(200)
+    store = MmapVectorStore(str(tmp_path), dtype=dtype)
+    store.add(nodes)
+
+    rng = np.random.default_rng(1)
+    for _ in range(10):
+        query_vector = rng.normal(size=DIM).astype(np.float32)
+        result = query(store, query_vector, top_k=5)
+        expected = [nodes[i].node_id for i in exact_top(vectors, query_vector, 5)]
+        assert result.ids[0] == expected[0]
+        assert len(set(result.ids) & set(expected)) >= 4
+
+    # Stored vectors come back as the normalized originals, within the dtype's precision
+    stored = np.asarray(store.get_embeddings([node.node_id for node in nodes]))
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    assert np.abs(1 - np.sum(stored * unit, axis=1)).max() < tolerance
+
+
+def test_ivf_recall_against_brute_force(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "ANN_MIN_ROWS", 1000)
+    # Clustered data, as real embeddings are, so the coarse lists mean something
+    rng = np.random.default_rng(2)
+    centers = rng.normal(size=(20, DIM))
+    nodes, _ = make_nodes(3000)
+    vectors = (centers[rng.integers(0, 20, size=3000)] + 0.3 * rng.normal(size=(3000, DIM))).astype(np.float32)
+    for node, vector in zip(nodes, vectors):
+        node.embedding = vector.tolist()
+
+    exact = MmapVectorStore(str(tmp_path), dtype="float32")
+    approximate = MmapVectorStore(str(tmp_path), dtype="float32", approximate=True)
+    exact.add(nodes)
+    approximate.add(nodes)
+    assert exact._segments[nodes[0].metadata["file_hash"]].ivf is not None
+
+    hits = total = 0
+    for query_vector in vectors[rng.choice(3000, size=50, replace=False)] + 0.1 * rng.normal(size=(50, DIM)):
+        expected = set(query(exact, query_vector, top_k=10).ids)
+        assert expected == {nodes[i].node_id for i in exact_top(vectors, query_vector, 10)}
+        hits += len(expected & set(query(approximate, query_vector, top_k=10).ids))
+        total += len(expected)
+    assert hits / total >= 0.9
+
+
+def test_delete_only_hides_rows_from_its_own_store(tmp_path):
+    nodes, vectors = make_nodes(100)
+    first = MmapVectorStore(str(tmp_path))
+    second = MmapVectorStore(str(tmp_path))
+    first.add(nodes)
+    second.add(nodes)
+    file_hash = nodes[0].metadata["file_hash"]
+    # One memory map shared by both stores
+    assert first._segments[file_hash] is second._segments[file_hash]
+
+    first.delete(nodes[0].ref_doc_id)
+
+    deleted = {node.node_id for node in nodes if node.ref_doc_id == nodes[0].ref_doc_id}
+    for node, query_vector in zip(nodes[:10], vectors):
+        assert not deleted & set(query(first, query_vector, top_k=20).ids)
+        assert query(second, query_vector, top_k=1).ids == [node.node_id]
+    assert first.get_embeddings([nodes[0].node_id]) == [None]
+    assert second.get_embeddings([nodes[0].node_id])[0] is not None
+
+    # Deleting the rest drops the segment from that store only
+    first.delete(nodes[1].ref_doc_id)
+    assert file_hash not in first._segments
+    assert query(first, vectors[0]).ids == []
+    assert len(query(second, vectors[0], top_k=100).ids) == 100
@@ -0,0 +1,397 @@
+import os
+import json
+import shutil
+import logging
+import threading
+from itertools import groupby
+from typing import Any
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.vector_stores.types import BasePydanticVectorStore, VectorStoreQueryResult
+from index_store import document_hash, temp_path
+
+logger = logging.getLogger(__name__)
+
+DTYPES = ("float32", "float16", "int8")
+
+# Segments with at least this many rows get a coarse (IVF) index when approximate search is on
+ANN_MIN_ROWS = int(os.getenv("PERSONAL_LLM_ANN_MIN_ROWS", 2048))
+SCAN_BLOCK_ROWS = 16384
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def _save_npy(path, array):
+    # Same temp-file-then-rename as IndexStore.save: readers never see half a file,
+    # and processes that already mapped the old file keep a valid mapping.
+    tmp_path = temp_path(path)
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def _rows(matrix, scales, index):
+    rows = matrix[index].astype(np.float32)
+    return rows if scales is None else rows * scales[index, None]
+
+
+def _build_ivf(matrix, scales=None, iterations=8, seed=0):
+    """
+    Spherical k-means over the stored unit vectors (a memory map, read in blocks): returns
+    centroids plus row order and offsets so that the rows of list c are order[offsets[c]:offsets[c + 1]].
+    """
+    n = len(matrix)
+    nlist = max(1, int(np.sqrt(n)))
+    rng = np.random.default_rng(seed)
+    sample = _rows(matrix, scales, np.sort(rng.choice(n, size=min(n, 50 * nlist), replace=False)))
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+
+    assign = np.concatenate([
+        np.argmax(_rows(matrix, scales, slice(i, i + 8192)) @ centroids.T, axis=1) for i in range(0, n, 8192)
+    ])
+    order = np.argsort(assign, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+    return centroids.astype(np.float32), order, offsets
+
+
+class _Segment:
+    """
+    The embeddings of one source file: a read-only memory map shared by every session
+    (and, through the page cache, every process) that indexes that file.
+    """
+    def __init__(self, matrix, scales, ids, ref_doc_ids, ivf):
+        self.matrix = matrix
+        self.scales = scales
+        self.ids = ids
+        self.ref_doc_ids = ref_doc_ids
+        self.ivf = ivf
+        self.rows_by_id = {node_id: row for row, node_id in enumerate(ids)}
+
+    def contains(self, node_ids):
+        return all(node_id in self.rows_by_id for node_id in node_ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, query, nprobe):
+        """
+        Candidate rows for a query: all of them, or the rows in the nprobe closest IVF lists.
+        """
+        if self.ivf is None:
+            return None
+        centroids, order, offsets = self.ivf
+        probes = np.argsort(-(centroids @ query))[:nprobe]
+        return np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probes])
+
+    def scores(self, query, rows=None):
+        # Scanned in blocks, upcast to float32 so the dot products go through BLAS
+        # without ever materializing the whole segment in float32.
+        n = len(self.ids) if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, SCAN_BLOCK_ROWS):
+            index = slice(start, start + SCAN_BLOCK_ROWS) if rows is None else rows[start:start + SCAN_BLOCK_ROWS]
+            scores[start:start + SCAN_BLOCK_ROWS] = self.matrix[index].astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+    def vector(self, row):
+        vector = self.matrix[row].astype(np.float32)
+        if self.scales is not None:
+            vector = vector * self.scales[row]
+        return vector
+
+
+def segment_path(persist_dir, dtype, file_hash, suffix):
+    return os.path.join(persist_dir, f"{file_hash}.{dtype}.{suffix}")
+
+
+def _read_ids(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["ids"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class SegmentWriter:
+    """
+    Writes one file's segment a slice of nodes at a time, so storing a large file never needs
+    all of its embeddings in memory: rows are appended to a raw temp file that becomes the .npy
+    on commit. As a context manager it commits on success and discards everything on error
+    (or a cancelled upload).
+    """
+    def __init__(self, persist_dir, dtype, file_hash):
+        self.persist_dir = persist_dir
+        self.dtype = dtype
+        self.file_hash = file_hash
+        self._raw_path = temp_path(self._path("raw"))
+        self._raw = open(self._raw_path, "wb")
+        self._ids = []
+        self._ref_doc_ids = []
+        self._scales = []
+        self._dim = 0
+
+    def _path(self, suffix):
+        return segment_path(self.persist_dir, self.dtype, self.file_hash, suffix)
+
+    def append(self, nodes):
+        if not nodes:
+            return
+        if any(not node.embedding for node in nodes):
+            raise ValueError(f"Nodes of {self.file_hash} have no embeddings to store.")
+        vectors = _normalize(np.asarray([node.embedding for node in nodes], dtype=np.float32))
+        self._dim = vectors.shape[1]
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self._raw.write(np.round(vectors / scales[:, None]).astype(np.int8).tobytes())
+            self._scales.append(scales.astype(np.float32))
+        else:
+            self._raw.write(vectors.astype(self.dtype).tobytes())
+        self._ids.extend(node.node_id for node in nodes)
+        self._ref_doc_ids.extend(node.ref_doc_id for node in nodes)
+
+    def commit(self):
+        self._raw.close()
+        if not self._ids:
+            self.abort()
+            return
+        # Same temp-file-then-rename as _save_npy, with the rows streamed in after the header
+        path = self._path("npy")
+        tmp_path = temp_path(path)
+        header = {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(self.dtype)),
+            "fortran_order": False,
+            "shape": (len(self._ids), self._dim),
+        }
+        with open(tmp_path, "wb") as out, open(self._raw_path, "rb") as raw:
+            np.lib.format.write_array_header_1_0(out, header)
+            shutil.copyfileobj(raw, out, 1024 * 1024)
+        os.replace(tmp_path, path)
+        os.remove(self._raw_path)
+
+        scales = None
+        if self.dtype == "int8":
+            scales = np.concatenate(self._scales)
+            _save_npy(self._path("scales.npy"), scales)
+        if len(self._ids) >= ANN_MIN_ROWS:
+            centroids, order, offsets = _build_ivf(np.load(path, mmap_mode="r"), scales)
+            tmp_path = temp_path(self._path("ivf.npz"))
+            with open(tmp_path, "wb") as f:
+                np.savez(f, centroids=centroids, order=order, offsets=offsets)
+            os.replace(tmp_path, self._path("ivf.npz"))
+        meta = {"ids": self._ids, "ref_doc_ids": self._ref_doc_ids}
+        # Written last: a segment only counts as stored once its ids are
+        path = self._path("ids.json")
+        tmp_path = temp_path(path)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def abort(self):
+        self._raw.close()
+        if os.path.exists(self._raw_path):
+            os.remove(self._raw_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class SegmentStore:
+    """
+    The segment files of one embedding model directory, for writing segments ahead of indexing
+    (see IndexStore.build_nodes). MmapVectorStore then maps them instead of writing them.
+    """
+    def __init__(self, persist_dir, dtype="float16"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported vector dtype {dtype!r}, expected one of {DTYPES}.")
+        os.makedirs(persist_dir, exist_ok=True)
+        self.persist_dir = persist_dir
+        self.dtype = dtype
+
+    def stored_ids(self, file_hash):
+        """
+        Node ids of a file's committed segment, in row order; None if there is none.
+        """
+        if not os.path.exists(segment_path(self.persist_dir, self.dtype, file_hash, "npy")):
+            return None
+        return _read_ids(segment_path(self.persist_dir, self.dtype, file_hash, "ids.json"))
+
+    def writer(self, file_hash):
+        return SegmentWriter(self.persist_dir, self.dtype, file_hash)
+
+
+# Open segments, shared process-wide: path -> _Segment
+_segments = {}
+_segments_lock = threading.Lock()
+
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """
+    Vector store backed by memory-mapped NumPy files, one per source file and embedding model,
+    stored as unit vectors in float32, float16 or int8 (with a per-row scale).
+    Search is a vectorized brute-force cosine scan; with approximate=True, large segments
+    are searched through a coarse IVF index instead. Text stays in the index's docstore.
+    Deleting only hides rows from this store; the shared files are left untouched.
+    """
+    stores_text: bool = False
+    is_embedding_query: bool = True
+    persist_dir: str
+    dtype: str = "float16"
+    approximate: bool = False
+
+    _segments: Any = PrivateAttr(default_factory=dict)  # file_hash -> _Segment
+    _masks: Any = PrivateAttr(default_factory=dict)  # file_hash -> bool array of visible rows
+    _locations: Any = PrivateAttr(default_factory=dict)  # node_id -> (file_hash, row)
+
+    def __init__(self, persist_dir, dtype="float16", approximate=False, **kwargs):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported vector dtype {dtype!r}, expected one of {DTYPES}.")
+        os.makedirs(persist_dir, exist_ok=True)
+        super().__init__(persist_dir=persist_dir, dtype=dtype, approximate=approximate, **kwargs)
+
+    @classmethod
+    def class_name(cls):
+        return "MmapVectorStore"
+
+    @property
+    def client(self):
+        return None
+
+    def _path(self, file_hash, suffix):
+        return segment_path(self.persist_dir, self.dtype, file_hash, suffix)
+
+    def _write_segment(self, file_hash, nodes):
+        with SegmentWriter(self.persist_dir, self.dtype, file_hash) as writer:
+            writer.append(nodes)
+
+    def _open_segment(self, file_hash, nodes):
+        # nodes may be only part of the file: VectorStoreIndex adds nodes in batches
+        path = self._path(file_hash, "npy")
+        ids = [node.node_id for node in nodes]
+        with _segments_lock:
+            segment = _segments.get(path)
+            if segment is None or not segment.contains(ids):
+                stored = self._stored_ids(file_hash)
+                if not os.path.exists(path) or stored is None or not set(ids) <= set(stored):
+                    self._write_segment(file_hash, nodes)
+                with open(self._path(file_hash, "ids.json"), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                scales_path = self._path(file_hash, "scales.npy")
+                ivf_path = self._path(file_hash, "ivf.npz")
+                ivf = None
+                if os.path.exists(ivf_path):
+                    with np.load(ivf_path) as data:
+                        ivf = (data["centroids"], data["order"], data["offsets"])
+                segment = _Segment(
+                    np.load(path, mmap_mode="r"),
+                    np.load(scales_path, mmap_mode="r") if os.path.exists(scales_path) else None,
+                    meta["ids"],
+                    meta["ref_doc_ids"],
+                    ivf,
+                )
+                _segments[path] = segment
+            return segment
+
+    def _stored_ids(self, file_hash):
+        return _read_ids(self._path(file_hash, "ids.json"))
+
+    def add(self, nodes, **kwargs):
+        added = []
+        for file_hash, file_nodes in groupby(nodes, key=document_hash):
+            file_nodes = list(file_nodes)
+            segment = self._open_segment(file_hash, file_nodes)
+            if self._segments.get(file_hash) is not segment:
+                self._segments[file_hash] = segment
+                self._masks[file_hash] = np.zeros(len(segment), dtype=bool)
+            # Only the rows of the nodes added become visible
+            mask = self._masks[file_hash]
+            for node in file_nodes:
+                row = segment.rows_by_id[node.node_id]
+                mask[row] = True
+                self._locations[node.node_id] = (file_hash, row)
+                added.append(node.node_id)
+        return added
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        for file_hash, segment in list(self._segments.items()):
+            mask = self._masks[file_hash]
+            for row, row_ref_doc_id in enumerate(segment.ref_doc_ids):
+                if row_ref_doc_id == ref_doc_id and mask[row]:
+                    mask[row] = False
+                    self._locations.pop(segment.ids[row], None)
+            if not mask.any():
+                del self._segments[file_hash]
+                del self._masks[file_hash]
+
+    def clear(self):
+        self._segments.clear()
+        self._masks.clear()
+        self._locations.clear()
+
+    def get_embeddings(self, node_ids):
+        """
+        Stored (normalized) embeddings for the given node ids; None for unknown ids.
+        """
+        embeddings = []
+        for node_id in node_ids:
+            location = self._locations.get(node_id)
+            if location is None:
+                embeddings.append(None)
+                continue
+            file_hash, row = location
+            embeddings.append(self._segments[file_hash].vector(row).tolist())
+        return embeddings
+
+    def query(self, query, **kwargs):
+        if query.query_embedding is None or not self._segments:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        vector = _normalize(np.asarray(query.query_embedding, dtype=np.float32))
+        allowed = set(query.node_ids) if query.node_ids else None
+        top_k = query.similarity_top_k
+
+        ids, scores = [], []
+        for file_hash, segment in self._segments.items():
+            rows = segment.rows(vector, nprobe=max(1, len(segment.ivf[0]) // 8)) if (
+                self.approximate and segment.ivf is not None
+            ) else None
+            segment_scores = segment.scores(vector, rows)
+            row_index = np.arange(len(segment)) if rows is None else rows
+            visible = self._masks[file_hash][row_index]
+            if allowed is not None:
+                visible &= np.fromiter((segment.ids[r] in allowed for r in row_index), bool, len(row_index))
+            segment_scores = np.where(visible, segment_scores, -np.inf)
+            # Only each segment's own top_k can make the overall top_k
+            if len(segment_scores) > top_k:
+                best = np.argpartition(-segment_scores, top_k)[:top_k]
+            else:
+                best = np.arange(len(segment_scores))
+            for i in best:
+                if np.isfinite(segment_scores[i]):
+                    ids.append(segment.ids[row_index[i]])
+                    scores.append(float(segment_scores[i]))
+
+        order = np.argsort(scores)[::-1][:top_k]
+        return VectorStoreQueryResult(
+            nodes=None,
+            similarities=[scores[i] for i in order],
+            ids=[ids[i] for i in order],
+        )